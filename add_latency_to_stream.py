@@ -3,7 +3,9 @@
 
 # rely on functions defined by analize_stream
 from analize_stream import *
-import shutil
+import collections
+from stream_storage import link_frame, write_virtual_stream, write_impairments, LINK_MODES, LINK_AUTO, LINK_VIRTUAL, IMPAIRMENT_KINDS
+from stream_index import frame_names, stream_signature
 
 parser = argparse.ArgumentParser()
 parser.add_argument("streamdir", help="Directory containing the original stream")
@@ -11,21 +13,36 @@ parser.add_argument("outputdir", help="Directory to put modified stream in. MUST
 parser.add_argument("delay_distribution", help="Probability distribution to be used, followed by its parameters (-h/--help for details)")
 
 
+parser.add_argument("-l", "--link", dest="link", default=LINK_AUTO, choices=LINK_MODES, help="How frames are written: hardlinks, reflinks or copies of the original ones ('auto' picks the first working), or 'virtual' to only store an index referring to the original stream")
+parser.add_argument("-s", "--seed", dest="seed", default=None, type=int, help="Seed of the random delays, to generate the same stream again")
+parser.add_argument("--loss", dest="loss", default=0.0, type=float, help="Probability each frame is lost")
+parser.add_argument("--burst-loss", dest="burst_loss", default=None, help="Gilbert-Elliott bursty loss 'P,R[,H]': P probability of entering the loss state, R of leaving it, H a frame survives it (default 0)")
+parser.add_argument("--reorder", dest="reorder", default=None, help="Reordering 'PROB,MAX': frames delivered, with probability PROB, after up to MAX following frames")
+parser.add_argument("--duplicate", dest="duplicate", default=0.0, type=float, help="Probability each frame is delivered twice")
 parser.add_argument("-v", "--verbose", dest="verbose", default=False, action=argparse.BooleanOptionalAction, help="Output vebose")
 
 
 # given a fake_metadata dictionary (obtained via *DelayGenerator.generate_fake_metadata),
-# create its folder and add its files
-def create_delayed_sequence(fake_metadata):
+# create its folder and add its files. Frames are not copied when
+# possible (see stream_storage.link_frame), virtual streams only store
+# the index (readers take the frames from the original stream)
+def create_delayed_sequence(fake_metadata, mode=LINK_AUTO):
     new_stream_dir = fake_metadata["streamDir"]
     os.mkdir(new_stream_dir)
     print(f"Created directory '{new_stream_dir}'")
-    cwd = os.getcwd()
-    for fkimg in fake_metadata["imgdata"]:
-        src = os.path.join(cwd, fkimg["original"]["path"])
-        dst = os.path.join(cwd, fkimg["path"])
-        shutil.copyfile(src, dst)
-    
+    if "impairments" in fake_metadata:
+        write_impairments(new_stream_dir, fake_metadata["impairments"])
+    if mode == LINK_VIRTUAL:
+        write_virtual_stream(new_stream_dir, fake_metadata["streamName"], fake_metadata["originalStreamDir"],
+            fake_metadata["picNum"], fake_metadata["picTime"], fake_metadata["originalIndex"])
+        return
+    # where the original frames are (files or container)
+    originals = index_to_metadata(fake_metadata["originalStreamDir"], fake_metadata["original"])["imgdata"]
+    used = collections.Counter()
+    for name, idx in zip(fake_metadata["names"].tolist(), fake_metadata["originalIndex"].tolist()):
+        used[link_frame(originals[idx], os.path.join(new_stream_dir, name), mode)] += 1
+    print("Frames written as:", ", ".join(f"{m} {n}" for m, n in used.items()))
+
     # Hadoop inspired termination
     with open(os.path.join(new_stream_dir, '_SUCCESS'), 'w'):
         pass
@@ -33,119 +50,331 @@ def create_delayed_sequence(fake_metadata):
 class DelayGenerator:
     # container_folder: folder in which the new delayed distribution
     # should be placed
-    def __init__(self, container_folder: str | None = None) -> None:
+    # seed: seed of the random generator, same seed => same delays
+    def __init__(self, container_folder: str | None = None, seed: int | None = None) -> None:
         self.container_folder = container_folder
+        self.seed(seed)
     def set_container_folder(self, container_folder):
         self.container_folder = container_folder
+    def seed(self, seed: int | None):
+        self.rng = np.random.default_rng(seed)
     def get_distribution_name(self) -> str:
         return self.__class__.delay_distribution_name
-    def generate_fake_metadata(self, original_metadata: dict) -> dict:
+    # folder created to store the delayed stream: its name reports the
+    # info about the applied delay distribution
+    def stream_dir(self, original_stream_name: str) -> str:
+        return os.path.join(self.container_folder, f"{original_stream_name}-{self.get_distribution_str()}")
+    # columnar description of the delayed stream, given the index of the
+    # original one (see stream_index.load_stream_index):
+    #   names           =>  file names of the delayed frames
+    #   picNum          =>  int64 picture numbers (unchanged)
+    #   picTime         =>  datetime64[us] delayed capture times
+    #   fileSize        =>  int64 sizes of the pictures (unchanged)
+    #   addedDelay      =>  float64 delays (ms) introduced by generator
+    #   originalIndex   =>  positions of the frames inside the original
+    #                       index
+    def generate_fake_metadata(self, original_index: dict) -> dict:
         # the stream name is alwai the same
-        original_stream_name = original_metadata["streamName"]
+        original_stream_name = original_index["streamName"]
 
         # the folder created to store the new sequence has a
-        # different name: it reports the info about the applied
-        # delay distribution
-        new_stream_dir = os.path.join(self.container_folder, f"{original_stream_name}-{self.get_distribution_str()}")
-
-        new_imgdata = list(
-            # add missing path - trick to update and return dictionary
-            map(lambda d: d.update({"path": os.path.join(new_stream_dir, d["basename"])}) or d,
-            # generate new fake item
-            map(lambda t: {
-                            "basename": f"{original_stream_name}-pic-N{t[0]['picNum']:06d}-{t[2]}.jpg",
-                            "picNum": t[0]["picNum"],
-                            "picTime": t[1],
-                            "picTimeStr": t[2],
-                            "fileSize": t[0]["fileSize"],
-                            # delay introduced by generator
-                            "addedDelay": t[3],
-                            # reference to the original data
-                            "original": t[0],
-                        },
-            # add also stringfied fake generation time
-            map(lambda t: (t[0], t[0]["picTime"] + t[1], (t[0]["picTime"] + t[1]).strftime('%Y-%m-%d_%H-%M-%S.%f'), t[1]),
-            # add fake delay to original sample
-            map(lambda original: ((original.update({"picNum": int(original["picNum"])}) or original), self.generate_timedelta_delay()),
-                original_metadata["imgdata"])
-            )))
-            )
-
-        fake_metadata = {
-            "camID": original_metadata["camID"],
+        # different name (see stream_dir)
+        new_stream_dir = self.stream_dir(original_stream_name)
+
+        count = len(original_index["picNum"])
+        delays = np.asarray(self.generate_delays(count), dtype=np.float64)
+        picTime = original_index["picTime"] + np.round(delays * 1000).astype(np.int64).astype("timedelta64[us]")
+        return {
+            "camID": original_index["camID"],
             "streamDir": new_stream_dir,
             "streamName": original_stream_name,
-            "streamTime": original_metadata["streamTime"],
-            # path to new files data (not written yet)
-            "images": list(map(lambda idata: idata["path"], new_imgdata)),
+            "streamTime": original_index["streamTime"],
             # count is constant
-            "imageCount": original_metadata["imageCount"],
-            # updated data
-            "imgdata": new_imgdata,
+            "imageCount": count,
+            "names": frame_names(original_stream_name, original_index["picNum"], picTime),
+            "picNum": original_index["picNum"],
+            "picTime": picTime,
+            "fileSize": original_index["fileSize"],
+            "addedDelay": delays,
+            "originalIndex": np.arange(count),
             # reference to old data
-            "originalMetadata": original_metadata,
+            "originalStreamDir": original_index["streamDir"],
+            "original": original_index,
         }
-        return fake_metadata
-    # get delay as timedelta
-    def generate_timedelta_delay(self) -> float:
-        return self.generate_float_delay() * datetime.timedelta(milliseconds=1)
     # method returning a strin describing the applied distribution
     def get_distribution_str(self) -> str:
         raise NotImplementedError()
-    # method called to get a random number generate accordingly the
-    # underlaying distribution
-    def generate_float_delay(self) -> float:
+    # method called to get count random delays (ms), as array, generated
+    # accordingly the underlaying distribution
+    def generate_delays(self, count: int) -> np.ndarray:
         raise NotImplementedError()
+    # single delay (ms)
+    def generate_float_delay(self) -> float:
+        return float(self.generate_delays(1)[0])
+    # get delay as timedelta
+    def generate_timedelta_delay(self) -> datetime.timedelta:
+        return self.generate_float_delay() * datetime.timedelta(milliseconds=1)
 
 
 class ConstantDelayGenerator(DelayGenerator):
     delay_distribution_name = "const"
-    def __init__(self, delay) -> None:
-        super().__init__()
+    def __init__(self, delay, seed=None) -> None:
+        super().__init__(seed=seed)
         self.delay = delay
     def get_distribution_str(self) -> str:
-        return f"norm_{self.delay}"
-    def generate_float_delay(self) -> float:
-        return self.delay
+        return f"const_{self.delay}"
+    def generate_delays(self, count: int) -> np.ndarray:
+        return np.full(count, self.delay, dtype=np.float64)
 
 
 class ExponentialDelayGenerator(DelayGenerator):
     delay_distribution_name = "exp"
-    def __init__(self, mean) -> None:
-        super().__init__()
+    def __init__(self, mean, seed=None) -> None:
+        super().__init__(seed=seed)
         self.mean = mean
     def get_distribution_str(self) -> str:
         return f"exp_{self.mean}"
-    def generate_float_delay(self) -> float:
-        return np.random.exponential(self.mean)
+    def generate_delays(self, count: int) -> np.ndarray:
+        return self.rng.exponential(self.mean, count)
 
 
 class NormalDelayGenerator(DelayGenerator):
-    delay_distribution_name = "exp"
-    def __init__(self, mu, sigma) -> None:
-        super().__init__()
-        self.mean = mu
+    delay_distribution_name = "norm"
+    def __init__(self, mu, sigma, seed=None) -> None:
+        super().__init__(seed=seed)
+        self.mu = mu
         self.sigma = sigma
     def get_distribution_str(self) -> str:
-        return f"exp_{self.mu}_{self.sigma}"
-    def generate_float_delay(self) -> float:
-        return np.random.normal(self.mu, self.sigma)
+        return f"norm_{self.mu}_{self.sigma}"
+    def generate_delays(self, count: int) -> np.ndarray:
+        return self.rng.normal(self.mu, self.sigma, count)
+
+
+# number of bins of the histograms describing empirical distributions
+EMPIRICAL_BINS = 256
+
+# delays (ms) measured on a recorded stream (directory) or read from a
+# trace file (.npy array or text file with a delay per line, first
+# column). Delays of a stream are the distances of the frames from the
+# regular schedule fitting their capture times (i.e. the jitter), the
+# smallest one being 0
+def load_delay_trace(source) -> np.ndarray:
+    if os.path.isdir(source):
+        index = load_stream_index(source)
+        order = np.argsort(index["picNum"], kind="stable")
+        picNum = index["picNum"][order].astype(np.float64)
+        times = (index["picTime"][order] - index["picTime"].min()).astype(np.int64) / 1000.0
+        if len(times) < 2:
+            raise ValueError(f"Not enough frames inside '{source}'")
+        schedule = np.polyval(np.polyfit(picNum, times, 1), picNum)
+        delays = times - schedule
+        return delays - delays.min()
+    if source.endswith(".npy"):
+        return np.load(source).astype(np.float64).ravel()
+    return np.loadtxt(source, delimiter=',', usecols=0, ndmin=1, comments='#', dtype=np.float64)
 
+# path of the file caching the distribution of the delays of source
+def cdf_cache_path(source) -> str:
+    source = os.path.normpath(source)
+    return os.path.join(os.path.dirname(source), f".{os.path.basename(source)}.delays-cdf.npy")
+
+# modification time of a trace, for streams the one of their index
+def trace_mtime(source) -> int:
+    return int(stream_signature(source)[1]) if os.path.isdir(source) else os.stat(source).st_mtime_ns
+
+# histogram (bins edges, CDF at the edges) of the delays of source,
+# cached as .npy until the source changes
+def load_delay_cdf(source, bins: int = EMPIRICAL_BINS):
+    cache = cdf_cache_path(source)
+    try:
+        if os.stat(cache).st_mtime_ns >= trace_mtime(source):
+            edges, cdf = np.load(cache)
+            if len(edges) == bins + 1:
+                return edges, cdf
+    except (OSError, ValueError):
+        pass
+    delays = load_delay_trace(source)
+    if len(delays) == 0:
+        raise ValueError(f"No delay found inside '{source}'")
+    counts, edges = np.histogram(delays, bins=bins)
+    cdf = np.concatenate([[0.0], np.cumsum(counts) / counts.sum()])
+    try:
+        np.save(cache, np.vstack([edges, cdf]))
+    except OSError:
+        # read-only location: simply do not cache
+        pass
+    return edges, cdf
+
+
+class EmpiricalDelayGenerator(DelayGenerator):
+    delay_distribution_name = "empirical"
+    def __init__(self, source, bins=EMPIRICAL_BINS, seed=None) -> None:
+        super().__init__(seed=seed)
+        self.source = source
+        self.bins = bins
+        self.edges, self.cdf = load_delay_cdf(source, bins)
+    def get_distribution_str(self) -> str:
+        return f"empirical_{os.path.basename(os.path.normpath(self.source))}_{self.bins}"
+    # inverse CDF: delays uniformly distributed inside each bin
+    def generate_delays(self, count: int) -> np.ndarray:
+        return np.interp(self.rng.random(count), self.cdf, self.edges)
+
+
+# the delays of the trace are applied in order (repeated if the stream is
+# longer than the trace), starting from the start-th one
+class ReplayDelayGenerator(DelayGenerator):
+    delay_distribution_name = "replay"
+    def __init__(self, source, start=0, seed=None) -> None:
+        super().__init__(seed=seed)
+        self.source = source
+        self.start = start
+        self.delays = load_delay_trace(source)
+        if len(self.delays) == 0:
+            raise ValueError(f"No delay found inside '{source}'")
+    def get_distribution_str(self) -> str:
+        return f"replay_{os.path.basename(os.path.normpath(self.source))}_{self.start}"
+    def generate_delays(self, count: int) -> np.ndarray:
+        return np.resize(np.roll(self.delays, -self.start), count)
+
+
+# impairments applied to a delayed stream (see generate_fake_metadata),
+# all probabilities are per frame:
+#   loss        =>  frames lost independently (Bernoulli)
+#   burst       =>  (p, r, h) Gilbert-Elliott bursty loss: p probability
+#                   of going from the good to the bad state, r of going
+#                   back, h probability a frame survives the bad state
+#   reorder     =>  (probability, max distance) frames delivered after up
+#                   to max distance following frames
+#   duplicate   =>  frames delivered twice
+# The affected picture numbers are stored with the stream (see
+# stream_storage.IMPAIRMENTS_FILE) so that compare_streams can score them
+class Impairments:
+    def __init__(self, loss=0.0, burst=None, reorder=None, duplicate=0.0, seed=None) -> None:
+        self.loss = loss
+        self.burst = burst
+        self.reorder = reorder
+        self.duplicate = duplicate
+        # not the same numbers drawn by the delay generator
+        self.rng = np.random.default_rng(None if seed is None else [seed, 1])
+    def is_empty(self) -> bool:
+        return not (self.loss or self.burst or self.reorder or self.duplicate)
+    def get_impairments_str(self) -> str:
+        parts = []
+        if self.loss:
+            parts.append(f"loss_{self.loss}")
+        if self.burst:
+            parts.append("ge_" + "_".join(map(str, self.burst)))
+        if self.reorder:
+            parts.append("reorder_" + "_".join(map(str, self.reorder)))
+        if self.duplicate:
+            parts.append(f"dup_{self.duplicate}")
+        return "-".join(parts)
+    # folder of the impaired version of the delayed stream stream_dir
+    def stream_dir(self, stream_dir: str) -> str:
+        return f"{stream_dir}-{self.get_impairments_str()}"
+    # lost frames according to the Gilbert-Elliott model: lengths of the
+    # good and bad periods are geometrically distributed
+    def burst_losses(self, count: int) -> np.ndarray:
+        p, r, h = self.burst
+        lengths = []
+        total = 0
+        while total < count:
+            # alternate good, bad, good, ... periods
+            good = self.rng.geometric(p, count) if p > 0 else np.full(count, count)
+            bad = self.rng.geometric(r, count) if r > 0 else np.full(count, count)
+            runs = np.stack([good, bad], axis=1).ravel()
+            lengths.append(runs)
+            total += runs.sum()
+        runs = np.concatenate(lengths)
+        bad = np.repeat(np.arange(len(runs)) % 2 == 1, runs)[:count]
+        return bad & (self.rng.random(count) >= h)
+    def lost_frames(self, count: int) -> np.ndarray:
+        lost = self.rng.random(count) < self.loss
+        if self.burst:
+            lost |= self.burst_losses(count)
+        return lost
+    # apply the impairments to the fake metadata (returned updated)
+    def apply(self, fake_metadata: dict) -> dict:
+        columns = ["picNum", "picTime", "fileSize", "addedDelay", "originalIndex"]
+        # delays alone, reordering excluded
+        delays = {"delayPicNum": fake_metadata["picNum"], "addedDelay": fake_metadata["addedDelay"]}
+        count = fake_metadata["imageCount"]
+        keep = ~self.lost_frames(count)
+        lost = fake_metadata["picNum"][~keep]
+        data = {c: fake_metadata[c][keep] for c in columns}
+        # delivery order
+        order = np.argsort(data["picTime"], kind="stable")
+        data = {c: v[order] for c, v in data.items()}
+        times = data["picTime"]
+        count = len(times)
+        reordered = np.zeros(0, dtype=np.int64)
+        if self.reorder and count > 1:
+            probability, distance = self.reorder
+            moved = np.flatnonzero(self.rng.random(count) < probability)
+            # delivered just after one of the following frames
+            target = np.minimum(moved + self.rng.integers(1, distance + 1, len(moved)), count - 1)
+            moved, target = moved[target > moved], target[target > moved]
+            times = times.copy()
+            times[moved] = data["picTime"][target] + np.timedelta64(1, 'us')
+            data["picTime"] = times
+            reordered = data["picNum"][moved]
+        duplicated = np.zeros(0, dtype=np.int64)
+        if self.duplicate and count > 0:
+            copies = np.flatnonzero(self.rng.random(count) < self.duplicate)
+            # delivered half way to the next frame
+            following = np.minimum(copies + 1, count - 1)
+            gap = np.maximum((data["picTime"][following] - data["picTime"][copies]) // 2, np.timedelta64(1, 'us'))
+            copy = {c: v[copies] for c, v in data.items()}
+            copy["picTime"] = data["picTime"][copies] + gap
+            data = {c: np.concatenate([data[c], copy[c]]) for c in columns}
+            duplicated = copy["picNum"]
+        # same order of the stream index
+        order = np.lexsort((data["picTime"], data["picNum"]))
+        data = {c: v[order] for c, v in data.items()}
+        fake_metadata.update(data)
+        fake_metadata["imageCount"] = len(data["picNum"])
+        fake_metadata["names"] = frame_names(fake_metadata["streamName"], data["picNum"], data["picTime"])
+        fake_metadata["streamDir"] = self.stream_dir(fake_metadata["streamDir"])
+        fake_metadata["impairments"] = {
+            "parameters": self.get_impairments_str(),
+            "lost": np.sort(lost),
+            "reordered": np.sort(reordered),
+            "duplicated": np.sort(duplicated),
+            **delays,
+        }
+        return fake_metadata
+
+# parse a parameter made of comma separated numbers
+def parse_numbers(parameter: str | None, name: str, count: tuple, types=float):
+    if parameter is None:
+        return None
+    values = parameter.split(',')
+    if len(values) not in count:
+        print_err(f"Invalid paramenter '{name}': '{parameter}'")
+    try:
+        return tuple(t(v) for t, v in zip(types if isinstance(types, tuple) else (types,) * len(values), values))
+    except ValueError:
+        print_err(f"Invalid paramenter '{name}': '{parameter}'")
 
 # parse the parameter expressing the required delay distribution and
-# return a callable to be used on the "metadata" object describing the
-# original "sequence", to generate a new metadata object describing
-# the new delayed sequence.
+# return a callable to be used on the index describing the original
+# "sequence", to generate a new metadata object describing the new
+# delayed sequence.
 #
-# N.B.: the metadata structure is the one returned by
-#   "analize_stream.get_stream_metadata"
-def parse_delay_distribution(delay_parameter: str, container_folder: str):
+# N.B.: the index structure is the one returned by
+#   "stream_index.load_stream_index"
+def parse_delay_distribution(delay_parameter: str, container_folder: str, seed: int | None = None):
     delay_distribution = None
 
     if delay_parameter == '-h' or delay_parameter == '--help':
         print('\t', "const,delay_ms     constant delay added to each sample")
         print('\t', "exp,mean_ms        exponentially distributed delay added to each sample")
         print('\t', "norm,mu_ms,sig_ms  normally distributed delay added to each sample")
+        print('\t', "empirical,source[,bins]")
+        print('\t', "                   delay distributed as the jitter of the source stream (directory) or")
+        print('\t', "                   as the delays (ms) of the source trace (.npy or one delay per line)")
+        print('\t', "replay,source[,start]")
+        print('\t', "                   delays of the source stream/trace applied in order")
 
         exit(0)
     else:
@@ -170,10 +399,24 @@ def parse_delay_distribution(delay_parameter: str, container_folder: str):
             mu = float(parameters[0])
             sigma = float(parameters[1])
             delay_distribution = NormalDelayGenerator(mu=mu, sigma=sigma)
+        elif dist_name == "empirical" or dist_name == "replay":
+            source = parameters[0]
+            if not os.path.exists(source):
+                print_err(f"ERROR: missing trace '{source}'")
+            try:
+                if dist_name == "empirical":
+                    bins = int(parameters[1]) if len(parameters) > 1 else EMPIRICAL_BINS
+                    delay_distribution = EmpiricalDelayGenerator(source=source, bins=bins)
+                else:
+                    start = int(parameters[1]) if len(parameters) > 1 else 0
+                    delay_distribution = ReplayDelayGenerator(source=source, start=start)
+            except ValueError as e:
+                print_err(f"ERROR: {e}\n" + f"Invalid paramenter 'delay_distribution': '{delay_parameter}'")
         else:
             print_err(f"Invalid paramenter 'delay_distribution': '{delay_parameter}'")
 
     delay_distribution.set_container_folder(container_folder)
+    delay_distribution.seed(seed)
     return delay_distribution
 
 
@@ -184,23 +427,39 @@ def parse():
     if not os.path.exists(args.outputdir):
         print_err(f"ERROR: output directory '{args.outputdir}' exists!")
     
-    delay_generator = parse_delay_distribution(args.delay_distribution, args.outputdir)
+    delay_generator = parse_delay_distribution(args.delay_distribution, args.outputdir, args.seed)
+
+    burst = parse_numbers(args.burst_loss, "burst-loss", (2, 3))
+    if burst is not None and len(burst) == 2:
+        burst = burst + (0.0,)
+    reorder = parse_numbers(args.reorder, "reorder", (2,), (float, int))
+    if reorder is not None and reorder[1] < 1:
+        print_err(f"Invalid paramenter 'reorder': '{args.reorder}'")
+    probabilities = [args.loss, args.duplicate] + list(burst or []) + ([reorder[0]] if reorder else [])
+    if any(not 0 <= p <= 1 for p in probabilities):
+        print_err("Probabilities must be inside [0, 1]")
+    impairments = Impairments(loss=args.loss, burst=burst, reorder=reorder, duplicate=args.duplicate, seed=args.seed)
 
-    return args.streamdir, args.outputdir, delay_generator, args.verbose
+    return args.streamdir, args.outputdir, delay_generator, impairments, args.link, args.verbose
 
 
 def main():
-    streamdir, outputdir, delay_generator, verbose = parse()
+    streamdir, outputdir, delay_generator, impairments, link, verbose = parse()
     print(f"Examining folder '{streamdir}' ... ", end='')
-    metadata = get_stream_metadata(streamdir)
+    try:
+        metadata = load_stream_index(streamdir)
+    except ValueError as e:
+        print_err(e)
     print("DONE!", f"Found {metadata['imageCount']} images")
     print("Generating fake delayed sequence ... ", end='')
     fake_metadata = delay_generator.generate_fake_metadata(metadata)
+    if not impairments.is_empty():
+        fake_metadata = impairments.apply(fake_metadata)
     print("DONE!")
     if verbose:
         pp =  pprint.PrettyPrinter(depth=4)
         pp.pprint(fake_metadata)
-    create_delayed_sequence(fake_metadata)
+    create_delayed_sequence(fake_metadata, link)
 
 if __name__ == "__main__":
     main()
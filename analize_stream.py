@@ -6,11 +6,11 @@ import timeit
 import os
 import datetime
 import sys
-import glob
 import argparse
 import numpy as np
-import re
 import pprint
+import json
+from stream_index import load_stream_index, index_to_metadata
 
 if __name__ == "__main__":
     import matplotlib
@@ -19,6 +19,8 @@ if __name__ == "__main__":
 
 parser = argparse.ArgumentParser()
 parser.add_argument("streamdir", help="Directory containing the stream")
+parser.add_argument("-r", "--report", dest="report", default=None, help="Where to store the JSON report (default: next to the stream directory)")
+parser.add_argument("-s", "--save", dest="save", nargs='+', default=None, help="Store the plots inside the given files (e.g. plots.png plots.svg) instead of showing them, no display is needed")
 parser.add_argument("-v", "--verbose", dest="verbose", default=False, action=argparse.BooleanOptionalAction, help="Output vebose")
 
 def print_err(*args, **kwarks):
@@ -32,103 +34,171 @@ def parse():
     args = parser.parse_args()
     if not os.path.exists(args.streamdir):
         print_err(f"ERROR: missing directory '{args.streamdir}'")
-    return args.streamdir, args.verbose
+    report = args.report if args.report else report_path(args.streamdir)
+    return args.streamdir, report, args.save, args.verbose
 
-# get stream picture as ordered list of file names
+# get stream picture as ordered list of file names, metadata come from
+# the (cached) index of the stream, see stream_index
 def get_stream_metadata(streamdir):
-    search_path = os.path.join(streamdir, "*.jpg")
-    images = glob.glob(search_path)
-    if len(images) == 0:
-        print_err(f"ERROR: no .jpg found inside '{streamdir}'")
-    images.sort()
-    f = os.path.basename(images[0]) # first filename took as reference 
-    # ensure all picture are from the same stream
-    # re with lookhaed assertion:
-    #   https://docs.python.org/3/library/re.html
-    m = re.match('^stream-(?P<camID>\w+)-(?P<streamtime>.+)(?=-pic-)', f)
-    streamname = m.string[m.start():m.end()]
-    bad = list(filter(lambda f: not f.startswith(streamname), map(os.path.basename, images)))
-    if len(bad) > 0:
-        print_err()
-    streamtime = datetime.datetime.strptime(m.group('streamtime'), '%Y-%m-%d_%H-%M-%S.%f')
-    # extract ID of the camera
-    camID = m.groups('camID')[0]
-
-    ## position of the first char after the '-pic-' part of the regex
-    #new_begin = m.end()+len('-pic-')
-
-    # extract metadata associated with images
-    remd = re.compile(f"^(?>{streamname}-pic-)N"+"(?P<picNum>\d+)-(?P<picTime>.+)\.jpg$")
-    imgdata = list(
-        map(lambda t: {
-                        "path": t[0],
-                        "basename": os.path.basename(t[0]),
-                        "picNum": t[1].group('picNum')[0],
-                        "picTimeStr": t[1].groups('picTime')[1],
-                        "picTime": datetime.datetime.strptime(t[1].groups()[1], '%Y-%m-%d_%H-%M-%S.%f'),
-                        "fileSize": os.path.getsize(t[0])
-                    },
-        map(lambda t: (t[0], remd.match(t[1])),
-        map(lambda imgpath: (imgpath, os.path.basename(imgpath)),
-            images)
-        ))
-    )
-
-    return {
-        "camID": camID,
-        "streamDir": os.path.join(os.getcwd(), streamdir),
-        "streamName": streamname,
-        "streamTime": streamtime,
-        "images": images,
-        "imageCount": len(images),
-        "imgdata": imgdata,
-    }
+    try:
+        index = load_stream_index(streamdir)
+    except ValueError as e:
+        print_err(e)
+    return index_to_metadata(streamdir, index)
 
 
 # extract timestamps in which pics have been captured
-def get_pic_times(metadata: dict) -> list[datetime.datetime]:
-    imgdata = metadata["imgdata"]
-    pictimes = list(map(lambda x: x['picTime'], imgdata))
-    return pictimes
+def get_pic_times(metadata: dict) -> np.ndarray:
+    if "picTime" in metadata:
+        return metadata["picTime"]
+    return np.array([x['picTime'] for x in metadata["imgdata"]], dtype="datetime64[us]")
 
+# capture times (datetime list or datetime64 array) as sorted int64
+# microseconds
+def pic_times_us(pictimes) -> np.ndarray:
+    return np.sort(np.asarray(pictimes, dtype="datetime64[us]").astype(np.int64))
 
 # get interarrival delta to compute distribution
-def calculate_inter_arrival_times(pictimes: list[datetime.datetime]) -> list[datetime.timedelta]:
-    # do not modify original
-    pictimes = pictimes.copy()
-    pictimes.sort(reverse=False)
-    inter_arrival_times = []
-    for idx in range(1,len(pictimes)):
-        inter_arrival_times.append( pictimes[idx] - pictimes[idx-1] )
-    return inter_arrival_times
+def calculate_inter_arrival_times(pictimes) -> np.ndarray:
+    return np.diff(pic_times_us(pictimes)).astype("timedelta64[us]")
 
 # put time origin in 0
-def calculate_delay_from_first(pictimes: list[datetime.datetime], first: None | datetime.datetime = None) -> list[datetime.timedelta]:
-    # do not modify original
-    pictimes = pictimes.copy()
-    pictimes.sort(reverse=False)
+def calculate_delay_from_first(pictimes, first: None | datetime.datetime = None) -> np.ndarray:
+    times = pic_times_us(pictimes)
+    if len(times) == 0:
+        return times.astype("timedelta64[us]")
     # difference from first?
-    if first is None:
-        first = pictimes[0]
-    ans = []
-    for t in pictimes:
-        ans.append(t - first)
-    return ans
+    first = times[0] if first is None else np.datetime64(first, 'us').astype(np.int64)
+    return (times - first).astype("timedelta64[us]")
 
 # get timedelta in milliseconds (as float)
-def timedelta2float_ms(deltas: list[datetime.timedelta]) -> list[float]:
-    ans = list(map(lambda td: td / datetime.timedelta(milliseconds=1), deltas))
-    return ans
+def timedelta2float_ms(deltas) -> np.ndarray:
+    return np.asarray(deltas, dtype="timedelta64[us]").astype(np.int64) / 1000.0
+
+# length (seconds) of the windows used to compute the effective FPS
+FPS_WINDOW = 1.0
+# reported percentiles of the inter-arrival times
+PERCENTILES = (50, 95, 99)
+
+# descriptive statistics (in ms) of an array of microseconds
+def describe_us(values: np.ndarray) -> dict:
+    if len(values) == 0:
+        return {}
+    ms = values / 1000.0
+    stats = {"min": float(ms.min()), "mean": float(ms.mean()), "std": float(ms.std())}
+    stats.update({f"p{p}": float(v) for p, v in zip(PERCENTILES, np.percentile(ms, PERCENTILES))})
+    stats["max"] = float(ms.max())
+    return stats
+
+# timing analysis of a stream, given capture times (datetime64 array or
+# datetime list) and picture numbers:
+#   interArrival    =>  statistics (ms) of the time between frames
+#   jitter          =>  std and mean variation (ms) between consecutive
+#                       inter-arrival times
+#   gaps            =>  missing picture numbers, as (first missing, count)
+#   fps             =>  overall FPS and statistics of the FPS measured
+#                       over sliding windows of fps_window seconds
+def analyze_timing(pictimes, picnums, fps_window: float = FPS_WINDOW) -> dict:
+    times = pic_times_us(pictimes)
+    nums = np.unique(np.asarray(picnums, dtype=np.int64))
+    inter_arrival = np.diff(times)
+    duration = int(times[-1] - times[0]) if len(times) else 0
+    _, window_fps = sliding_fps(times.astype("datetime64[us]"), fps_window)
+    # missing picture numbers
+    steps = np.diff(nums)
+    holes = np.flatnonzero(steps > 1)
+    return {
+        "frames": int(len(times)),
+        "durationMs": duration / 1000.0,
+        "interArrival": describe_us(inter_arrival),
+        "jitter": {
+            "stdMs": float(inter_arrival.std() / 1000.0) if len(inter_arrival) else 0.0,
+            "meanVariationMs": float(np.abs(np.diff(inter_arrival)).mean() / 1000.0) if len(inter_arrival) > 1 else 0.0,
+        },
+        "gaps": {
+            "duplicated": int(len(picnums) - len(nums)),
+            "missing": int((steps[holes] - 1).sum()),
+            "holes": [[int(nums[i] + 1), int(steps[i] - 1)] for i in holes],
+        },
+        "fps": {
+            "overall": float((len(times) - 1) * 1e6 / duration) if duration > 0 else 0.0,
+            "window": fps_window,
+            "min": float(window_fps.min()) if len(window_fps) else None,
+            "mean": float(window_fps.mean()) if len(window_fps) else None,
+            "max": float(window_fps.max()) if len(window_fps) else None,
+        },
+    }
+
+# sliding window FPS, as (window start from first frame in ms, fps)
+def sliding_fps(pictimes, fps_window: float = FPS_WINDOW):
+    times = pic_times_us(pictimes)
+    if len(times) == 0:
+        return np.zeros(0), np.zeros(0)
+    window = int(fps_window * 1e6)
+    # frames in [t, t + window) starting from each frame
+    inside = np.searchsorted(times, times + window, side='left') - np.arange(len(times))
+    # windows running past the end of the stream are not complete
+    complete = times + window <= times[-1]
+    return (times[complete] - times[0]) / 1000.0, inside[complete] / fps_window
+
+# timing analysis of the stream described by an index (see
+# stream_index.load_stream_index), with the info about the stream
+def stream_report(index: dict) -> dict:
+    report = analyze_timing(index["picTime"], index["picNum"])
+    report.update({
+        "streamName": index["streamName"],
+        "camID": index["camID"],
+        "streamTime": index["streamTime"],
+        "totalSize": int(index["fileSize"].sum()),
+    })
+    return report
+
+# figure with the distribution of the inter-arrival times, the delay
+# from the first frame and the sliding window FPS. The backend has to be
+# chosen by the caller
+def plot_timing(pictimes, title: str | None = None):
+    import matplotlib.pyplot as plt
+    # see how interarrival times are distributed
+    inter_arrival_times_float = timedelta2float_ms(calculate_inter_arrival_times(pictimes))
+    # see if arrival rate is "stable" (no random wait)
+    # derivative should seem constant
+    delay_from_first_float = timedelta2float_ms(calculate_delay_from_first(pictimes))
+
+    fig, (ax0, ax1, ax2) = plt.subplots(1, 3, figsize=(18, 4))
+    ax0.hist(inter_arrival_times_float)
+    ax0.set_xlabel("inter-arrival time (ms)")
+    ax1.plot(np.arange(len(delay_from_first_float)), delay_from_first_float)
+    ax1.set_xlabel("frame")
+    ax1.set_ylabel("delay from first (ms)")
+    ax2.plot(*sliding_fps(pictimes))
+    ax2.set_xlabel("time (ms)")
+    ax2.set_ylabel("fps")
+    if title:
+        fig.suptitle(title)
+    return fig
+
+# default position of the JSON report: next to the stream directory, so
+# that the directory (and its index) is not modified
+def report_path(streamdir) -> str:
+    return os.path.normpath(streamdir) + ".analysis.json"
+
+def store_report(report: dict, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
 
 
 def main():
-    matplotlib.use('TKAgg')
+    streamdir, reportfile, save, verbose = parse()
+    # without a display plots can only be stored
+    matplotlib.use('Agg' if save else 'TKAgg')
     #matplotlib.use('WebAgg')
 
-    streamdir, verbose = parse()
     print(f"Examining folder '{streamdir}' ...")
 
-    metadata = get_stream_metadata(streamdir)
+    try:
+        metadata = load_stream_index(streamdir)
+    except ValueError as e:
+        print_err(e)
 
     print("Result of the analysis:")
     if verbose:
@@ -142,27 +212,23 @@ def main():
         print('\t', "streamTime", '\t=>', metadata["streamTime"])
     print()
     print('\t', "imageCount", '\t=>', metadata["imageCount"])
-    print('\t', "total stream size", '\t=>', f'{sum(map(lambda x: x["fileSize"], metadata["imgdata"])):,} bytes')
-    # compute average time difference between consecutive images
-    imgdata = metadata["imgdata"]
-    # img arrival times
-    pictimes = get_pic_times(metadata)
-
-    # see how interarrival times are distributed
-    inter_arrival_times = calculate_inter_arrival_times(pictimes)
-    inter_arrival_times_float = timedelta2float_ms(inter_arrival_times)
-
-    # see if arrival rate is "stable" (no random wait)
-    # derivative should seem constant
-    delay_from_first = calculate_delay_from_first(pictimes)
-    delay_from_first_float = timedelta2float_ms(delay_from_first)
+    print('\t', "total stream size", '\t=>', f'{int(metadata["fileSize"].sum()):,} bytes')
+    report = stream_report(metadata)
+    print('\t', "inter-arrival (ms)", '\t=>', ", ".join(f"{k} {v:.3f}" for k, v in report["interArrival"].items()))
+    print('\t', "jitter (ms)", '\t=>', ", ".join(f"{k} {v:.3f}" for k, v in report["jitter"].items()))
+    print('\t', "missing pics", '\t=>', report["gaps"]["missing"], f'({len(report["gaps"]["holes"])} gaps)')
+    print('\t', "fps", '\t=>', f'{report["fps"]["overall"]:.2f}')
+    store_report(report, reportfile)
+    print(f"Report stored inside '{reportfile}'")
 
     # generate figures
-    fig, (ax0, ax1) = plt.subplots(1, 2, figsize=(12, 4))
-    ax0.hist(inter_arrival_times_float)
-    ax1.plot(list(range(len(delay_from_first_float))), delay_from_first_float)
-
-    plt.show()
+    fig = plot_timing(metadata["picTime"])
+    if save:
+        for path in save:
+            fig.savefig(path)
+            print(f"Plots stored inside '{path}'")
+    else:
+        plt.show()
 
 
 if __name__ == "__main__":
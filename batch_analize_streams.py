@@ -0,0 +1,161 @@
+
+# Analyze, without display, all the streams (stream-* directories) found
+# under the given root directory. Streams are analyzed in parallel by
+# worker processes, for each of them the plots and the JSON report are
+# stored inside the output directory together with a combined summary
+# (CSV and JSON). Streams unchanged since the last run are skipped.
+
+import os
+import sys
+import json
+import csv
+import argparse
+import concurrent.futures
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from analize_stream import print_err, stream_report, plot_timing, store_report
+from stream_index import load_stream_index, stream_signature
+
+# summary files (inside the output directory)
+SUMMARY_JSON = "summary.json"
+SUMMARY_CSV = "summary.csv"
+PLOT_FORMATS = ("png", "svg")
+# columns of the CSV summary: (name, path inside the report)
+SUMMARY_COLUMNS = [
+    ("frames", ("frames",)),
+    ("duration_ms", ("durationMs",)),
+    ("total_size", ("totalSize",)),
+    ("fps", ("fps", "overall")),
+    ("fps_min", ("fps", "min")),
+    ("inter_arrival_mean_ms", ("interArrival", "mean")),
+    ("inter_arrival_p50_ms", ("interArrival", "p50")),
+    ("inter_arrival_p95_ms", ("interArrival", "p95")),
+    ("inter_arrival_p99_ms", ("interArrival", "p99")),
+    ("inter_arrival_max_ms", ("interArrival", "max")),
+    ("jitter_ms", ("jitter", "stdMs")),
+    ("missing", ("gaps", "missing")),
+    ("duplicated", ("gaps", "duplicated")),
+]
+
+parser = argparse.ArgumentParser()
+parser.add_argument("rootdir", help="Directory containing (at any depth) the streams to analyze")
+parser.add_argument("-o", "--outputdir", dest="outputdir", default=None, help="Where to put plots, reports and summary (default: ROOTDIR/analysis)")
+parser.add_argument("-w", "--workers", dest="workers", default=None, type=int, help="Number of worker processes (default: number of CPUs)")
+parser.add_argument("-f", "--format", dest="formats", nargs='+', default=list(PLOT_FORMATS), choices=PLOT_FORMATS, help="Formats of the stored plots")
+parser.add_argument("--force", dest="force", default=False, action=argparse.BooleanOptionalAction, help="Analyze again also the unchanged streams")
+
+def parse():
+    args = parser.parse_args()
+    if not os.path.isdir(args.rootdir):
+        print_err(f"ERROR: missing directory '{args.rootdir}'")
+    outputdir = args.outputdir if args.outputdir else os.path.join(args.rootdir, "analysis")
+    if args.workers is not None and args.workers < 1:
+        print_err("Invalid parameter workers:", args.workers)
+    return args.rootdir, outputdir, args.workers, args.formats, args.force
+
+# stream directories under rootdir (stream directories are not explored)
+def find_streams(rootdir, skip=None) -> list[str]:
+    streams = []
+    for dirpath, dirnames, _ in os.walk(rootdir):
+        if skip is not None and os.path.abspath(dirpath) == os.path.abspath(skip):
+            dirnames.clear()
+            continue
+        found = [d for d in dirnames if d.startswith("stream-")]
+        streams.extend(os.path.join(dirpath, d) for d in found)
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("stream-"))
+    streams.sort()
+    return streams
+
+# name used for the output files of a stream (unique within rootdir)
+def output_name(rootdir, streamdir) -> str:
+    return os.path.relpath(streamdir, rootdir).replace(os.sep, "__")
+
+# worker: analyze a stream, store its report and plots
+def analyze_stream(streamdir, name, outputdir, formats):
+    index = load_stream_index(streamdir)
+    report = stream_report(index)
+    report["streamDir"] = streamdir
+    report["signature"] = index["signature"].tolist()
+    store_report(report, os.path.join(outputdir, f"{name}.json"))
+    fig = plot_timing(index["picTime"], title=index["streamName"])
+    for fmt in formats:
+        fig.savefig(os.path.join(outputdir, f"{name}.{fmt}"))
+    plt.close(fig)
+    return report
+
+# reports of the previous run, by output name
+def load_summary(outputdir) -> dict:
+    try:
+        with open(os.path.join(outputdir, SUMMARY_JSON)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# is the analysis of the previous run still valid?
+def is_unchanged(streamdir, name, outputdir, formats, previous) -> bool:
+    report = previous.get(name)
+    if report is None:
+        return False
+    if any(not os.path.exists(os.path.join(outputdir, f"{name}.{fmt}")) for fmt in formats):
+        return False
+    try:
+        return report["signature"] == stream_signature(streamdir).tolist()
+    except OSError:
+        return False
+
+def summary_value(report: dict, keys):
+    for k in keys:
+        report = report.get(k) if isinstance(report, dict) else None
+    return "" if report is None else report
+
+def store_summary(outputdir, reports: dict):
+    with open(os.path.join(outputdir, SUMMARY_JSON), 'w') as f:
+        json.dump(reports, f, indent=2, default=str)
+    with open(os.path.join(outputdir, SUMMARY_CSV), 'w', newline='') as f:
+        # stream paths may contain commas or quotes
+        writer = csv.writer(f)
+        writer.writerow(["stream", "camID", "streamDir"] + [c for c, _ in SUMMARY_COLUMNS])
+        for name, report in reports.items():
+            writer.writerow([name, report["camID"], report["streamDir"]] + [summary_value(report, keys) for _, keys in SUMMARY_COLUMNS])
+
+def main():
+    rootdir, outputdir, workers, formats, force = parse()
+    os.makedirs(outputdir, exist_ok=True)
+    streams = find_streams(rootdir, skip=outputdir)
+    print(f"Found {len(streams)} streams inside '{rootdir}'")
+
+    previous = {} if force else load_summary(outputdir)
+    reports = {}
+    todo = []
+    for streamdir in streams:
+        name = output_name(rootdir, streamdir)
+        if is_unchanged(streamdir, name, outputdir, formats, previous):
+            reports[name] = previous[name]
+        else:
+            todo.append((streamdir, name))
+    print(f"Streams to analyze: {len(todo)} (unchanged: {len(reports)})")
+
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(analyze_stream, streamdir, name, outputdir, formats): (streamdir, name) for streamdir, name in todo}
+        for future in concurrent.futures.as_completed(futures):
+            streamdir, name = futures[future]
+            try:
+                reports[name] = future.result()
+                print(f"Analyzed '{streamdir}'")
+            except Exception as e:
+                # a broken stream must not stop the analysis of the others
+                failed += 1
+                print(f"Failed to analyze '{streamdir}': {e!r}", file=sys.stderr)
+
+    reports = dict(sorted(reports.items()))
+    store_summary(outputdir, reports)
+    print(f"Summary of {len(reports)} streams stored inside '{outputdir}'")
+    if failed:
+        print(f"{failed} streams could not be analyzed", file=sys.stderr)
+        exit(1)
+
+if __name__ == "__main__":
+    main()
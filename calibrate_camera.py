@@ -8,6 +8,7 @@ import argparse
 import numpy as np
 import glob
 from undistort_folder import calculate_undistortion_params, show_undistorted_images
+from chessboard import BoardDetector, IncrementalCalibrator, INCREMENTAL_MIN_VIEWS
 
 calibration_img_width_file = "calibration_img_width.npy"
 calibration_img_height_file = "calibration_img_height.npy"
@@ -18,6 +19,12 @@ calibration_dist_file = "calibration_dist.npy"
 ROWS = 6
 COLS = 9
 
+# live detection: frames are downscaled at least this many times
+PREVIEW_PYRAMID_LEVELS = 1
+# live detection: a frame can be captured only if the board was seen
+# in a frame at most this old (seconds)
+BOARD_MAX_AGE = 0.5
+
 basedir = os.path.dirname(__file__)
 
 parser = argparse.ArgumentParser()
@@ -25,6 +32,13 @@ parser.add_argument("cameraId", help="Argument for cv2.VideoCapture(0)")
 parser.add_argument("picdir", help="Directory in which selected frame will be put")
 parser.add_argument("-r", "--resolution", dest="resolution", default=None, help="Argument for cv2.VideoCapture(0)")
 parser.add_argument("-c", "--chessboard", dest="chessboard", default=None, help="Chessboard 'ROWS,COLS' size")
+parser.add_argument("-w", "--workers", dest="workers", default=None, type=int, help="Number of threads used to detect the chessboard (default: one per CPU)")
+parser.add_argument("-l", "--pyramid-levels", dest="pyramid_levels", default=0, type=int, help="Search the chessboard on frames downscaled N times before refining it")
+parser.add_argument("--fast-check", dest="fast_check", default=False, action=argparse.BooleanOptionalAction, help="Quickly reject frames without a chessboard")
+parser.add_argument("--live-detection", dest="live_detection", default=True, action=argparse.BooleanOptionalAction, help="Show the detected chessboard on the preview and reject captures without it")
+parser.add_argument("--incremental", dest="incremental", default=False, action=argparse.BooleanOptionalAction, help="Calibrate while capturing, stop once the reprojection error converges")
+parser.add_argument("--max-views", dest="max_views", default=None, type=int, help=f"(Incremental) Stop after this many views (at least {INCREMENTAL_MIN_VIEWS})")
+parser.add_argument("--tolerance", dest="tolerance", default=0.01, type=float, help="(Incremental) Relative RMS change under which calibration is considered converged")
 
 # STATS parameters
 MEASURES_PER_STATS = 50
@@ -53,7 +67,12 @@ def parse():
     if os.path.exists(picdirname):
         print_err(f"Invalid path '{picdirname}'")
 
-    return args.cameraId, args.resolution, picdirname, args.chessboard
+    if args.pyramid_levels < 0:
+        print_err("Invalid parameter pyramid-levels:", args.pyramid_levels)
+    if args.max_views is not None and args.max_views < INCREMENTAL_MIN_VIEWS:
+        print_err(f"Invalid parameter max-views (at least {INCREMENTAL_MIN_VIEWS} views are needed):", args.max_views)
+
+    return args.cameraId, args.resolution, picdirname, args.chessboard, args.workers, args.pyramid_levels, args.fast_check, args.live_detection, args.incremental, args.max_views, args.tolerance
 
 # commands available to the user
 def display_commands():
@@ -97,6 +116,17 @@ def camera_proprerties(vcap, new_resolution=None):
     print()
 
 
+# print incremental calibration status on the preview
+def draw_calibration_status(img, calibrator):
+    views, rms, converged = calibrator.status()
+    text = f"views: {views}"
+    if rms is not None:
+        text += f"  RMS: {rms:.4f}"
+    if converged:
+        text += "  CONVERGED"
+    cv2.putText(img, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+
+
 def store_img(picdirname, img):
     now = datetime.datetime.now()
     filename = f"pic-{now.strftime('%Y-%m-%d_%H-%M-%S.%f')}.jpg"
@@ -106,7 +136,7 @@ def store_img(picdirname, img):
 
 
 def main():
-    cameraId, resolution, picdirname, (cb_ROWS, cb_COLS) = parse()
+    cameraId, resolution, picdirname, (cb_ROWS, cb_COLS), workers, pyramid_levels, fast_check, live_detection, incremental, max_views, tolerance = parse()
     picdir = False
     print(f"cameraId: {cameraId}")
     print(f"Calibration images will be stored inside '{picdirname}'")
@@ -119,6 +149,15 @@ def main():
 
     display_commands()
 
+    # chessboard detection runs in background, never stalling vcap.read()
+    detector = None
+    if live_detection:
+        detector = BoardDetector(cb_ROWS, cb_COLS, pyramid_levels=max(pyramid_levels, PREVIEW_PYRAMID_LEVELS))
+    # calibration solved in background after each captured frame
+    calibrator = None
+    if incremental:
+        calibrator = IncrementalCalibrator(cb_ROWS, cb_COLS, max_views=max_views, tolerance=tolerance, pyramid_levels=pyramid_levels, fast_check=fast_check)
+
     quit = False
     while True:
         start = timeit.default_timer()
@@ -132,10 +171,22 @@ def main():
             # store delta only if it is valid
             stats.append(delta)
 
-            cv2.imshow(img_title, frame)
+            preview = frame
+            if detector is not None or calibrator is not None:
+                # draw on a copy, stored frames must stay clean
+                preview = frame.copy()
+            if detector is not None:
+                detector.submit(start + delta, frame)
+                detector.draw(preview)
+            if calibrator is not None:
+                draw_calibration_status(preview, calibrator)
+            cv2.imshow(img_title, preview)
             key = cv2.waitKey(1)
             if key == ord('q'):
                 quit = True
+            elif key == ord(' ') and detector is not None and not detector.board_visible(timeit.default_timer(), BOARD_MAX_AGE):
+                print("No chessboard visible, frame rejected")
+                print()
             elif key == ord(' '):
                 print("Caputed image for calibration")
                 if not picdir:
@@ -144,6 +195,11 @@ def main():
                     picdir = True
                 # save image
                 store_img(picdirname, frame)
+                if calibrator is not None:
+                    calibrator.add_frame(frame)
+            if calibrator is not None and calibrator.status()[2]:
+                print("Calibration converged")
+                quit = True
 
         if quit or key == ord('i') or len(stats) == MEASURES_PER_STATS:
             statistics(stats)
@@ -151,11 +207,21 @@ def main():
         # exit only after last stats have been published 
         if quit:
             cv2.destroyWindow(img_title)
+            if detector is not None:
+                detector.stop()
+            if calibrator is not None:
+                calibrator.stop()
             print("Quit")
             break
 
-    print("Perform camera calibration")
-    ret, mtx, dist, rvecs, tvecs = calculate_undistortion_params(picdirname, cb_ROWS, cb_COLS)
+    solution = calibrator.get_solution() if calibrator is not None else None
+    if solution is not None:
+        # reuse the last incremental solution
+        ret, mtx, dist, rvecs, tvecs = solution
+        print(f"Using incremental calibration (RMS reprojection error: {ret})")
+    else:
+        print("Perform camera calibration")
+        ret, mtx, dist, rvecs, tvecs = calculate_undistortion_params(picdirname, cb_ROWS, cb_COLS, workers=workers, pyramid_levels=pyramid_levels, fast_check=fast_check)
     show_undistorted_images(picdirname, mtx, dist)
 
     # store calibration parameters
@@ -0,0 +1,406 @@
+import cv2
+import os
+import time
+import timeit
+import datetime
+import numpy as np
+import threading
+import queue
+
+# default size of the queues between grabber, main loop and writers
+QUEUE_SIZE = 64
+# default number of writer threads
+WRITERS = 2
+
+# ask the camera to send MJPG compressed frames, return True if the
+# camera accepted
+#   https://stackoverflow.com/questions/54249824/low-fps-by-using-cv2-videocapture
+def negotiate_mjpeg(vcap) -> bool:
+    fourcc = cv2.VideoWriter.fourcc('M','J','P','G')
+    if not vcap.set(cv2.CAP_PROP_FOURCC, fourcc):
+        return False
+    return int(vcap.get(cv2.CAP_PROP_FOURCC)) == fourcc
+
+# is the frame a buffer containing an encoded JPEG (instead of a
+# decoded BGR image)?
+def is_jpeg_buffer(frame) -> bool:
+    return frame.dtype == np.uint8 and frame.size > 2 and (frame.ndim == 1 or frame.shape[0] == 1) \
+        and frame.flat[0] == 0xFF and frame.flat[1] == 0xD8
+
+# make the camera return the compressed JPEG bytes sent by the camera,
+# without decoding them (only supported by some backends, e.g. V4L2).
+# Return True if the camera is really returning raw JPEG buffers.
+def enable_raw_mode(vcap) -> bool:
+    if not vcap.set(cv2.CAP_PROP_FORMAT, -1):
+        return False
+    ret, frame = vcap.read()
+    if ret and is_jpeg_buffer(frame):
+        return True
+    # restore decoded frames
+    vcap.set(cv2.CAP_PROP_FORMAT, 0)
+    return False
+
+# get a displayable BGR image from a (possibly raw) frame
+def decode_frame(frame):
+    if is_jpeg_buffer(frame):
+        return cv2.imdecode(frame.reshape(-1), cv2.IMREAD_COLOR)
+    return frame
+
+# frame grabber: a dedicated thread reads the camera, timestamps each
+# frame right at capture and puts it inside a bounded queue. If the
+# consumer is too slow new frames are dropped (and counted).
+class FrameGrabber:
+    def __init__(self, vcap, queue_size=QUEUE_SIZE) -> None:
+        self.vcap = vcap
+        # items: (frame, capture datetime, vcap.read duration)
+        # None is put when the camera cannot be read anymore
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    def run(self):
+        while self.running:
+            start = timeit.default_timer()
+            ret, frame = self.vcap.read()
+            delta = timeit.default_timer() - start
+            # time reference to be used for stream construction
+            now = datetime.datetime.now()
+            if not ret:
+                self.frames.put(None)
+                return
+            try:
+                self.frames.put_nowait((frame, now, delta))
+            except queue.Full:
+                self.dropped += 1
+    # next captured frame as (frame, datetime, read duration), None when
+    # the camera cannot be read anymore
+    def get(self):
+        return self.frames.get()
+    # are more frames already waiting?
+    def has_more(self) -> bool:
+        return not self.frames.empty()
+    def queue_depth(self) -> int:
+        return self.frames.qsize()
+    def stop(self):
+        self.running = False
+        # unblock the grabber if it's waiting on a full queue
+        while self.thread.is_alive():
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout=0.1)
+
+
+# policies applied by FrameWriter when its queue is full
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+BLOCK = "block"
+WRITER_POLICIES = [DROP_NEWEST, DROP_OLDEST, BLOCK]
+
+# default JPEG quality (same as cv2.imwrite)
+JPEG_QUALITY = 95
+
+# pool of threads encoding and storing frames, so that disk latency does
+# not slow down the capture (cv2 releases the GIL while encoding). Raw
+# JPEG buffers (see enable_raw_mode) are stored as they are.
+# Frames are stored in 'path' or, if it's a callable, passed to it
+# encoded (e.g. to be appended to a StreamContainerWriter).
+# Memory is bounded by the size of the queue, when it is full 'policy'
+# decides whether to block the caller until there is room again (the
+# default: recorded streams are complete), drop the new frame or drop the
+# oldest queued one.
+class FrameWriter:
+    def __init__(self, workers=WRITERS, queue_size=QUEUE_SIZE, policy=BLOCK, quality=JPEG_QUALITY) -> None:
+        if policy not in WRITER_POLICIES:
+            raise ValueError(f"Invalid writer policy '{policy}'")
+        self.policy = policy
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        # items: (path, frame), None to stop a worker
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+        # dropped frames and errors already reported by flush
+        self.flushed_dropped = 0
+        self.flushed_errors = 0
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(workers)]
+        for t in self.threads:
+            t.start()
+    def run(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                self.frames.task_done()
+                return
+            path, frame = item
+            if is_jpeg_buffer(frame):
+                ok, buf = True, frame
+            else:
+                ok, buf = cv2.imencode('.jpg', frame, self.params)
+            try:
+                if ok and callable(path):
+                    path(buf)
+                elif ok:
+                    buf.tofile(path)
+            except OSError:
+                ok = False
+            with self.lock:
+                if ok:
+                    self.written += 1
+                else:
+                    self.errors += 1
+            self.frames.task_done()
+    # queue a frame to be stored in path (file path or callable receiving
+    # the JPEG buffer), return False if it was dropped
+    def submit(self, path, frame) -> bool:
+        if self.policy == BLOCK:
+            self.frames.put((path, frame))
+            return True
+        while True:
+            try:
+                self.frames.put_nowait((path, frame))
+                return True
+            except queue.Full:
+                pass
+            if self.policy == DROP_NEWEST:
+                with self.lock:
+                    self.dropped += 1
+                return False
+            # DROP_OLDEST: make room and retry
+            try:
+                self.frames.get_nowait()
+                self.frames.task_done()
+                with self.lock:
+                    self.dropped += 1
+            except queue.Empty:
+                pass
+    def queue_depth(self) -> int:
+        return self.frames.qsize()
+    # wait for all the queued frames to be on disk, return the number of
+    # frames which were dropped or could not be written since the previous
+    # flush (i.e. missing from the stream being terminated)
+    def flush(self) -> int:
+        self.frames.join()
+        with self.lock:
+            lost = self.dropped - self.flushed_dropped + self.errors - self.flushed_errors
+            self.flushed_dropped = self.dropped
+            self.flushed_errors = self.errors
+        return lost
+    # wait for all the queued frames to be on disk, then mark the
+    # directory as complete. The directory is not marked (and False is
+    # returned) when some frame was dropped or could not be written
+    def flush_and_mark(self, dirpath) -> bool:
+        if self.flush():
+            return False
+        # Hadoop inspired termination
+        with open(os.path.join(dirpath, '_SUCCESS'), 'w'):
+            pass
+        return True
+    # wait for all the queued frames to be written and stop the workers
+    def stop(self):
+        for _ in self.threads:
+            self.frames.put(None)
+        for t in self.threads:
+            t.join()
+
+
+# clock triggering synchronized captures: every 1/fps seconds the tick
+# counter is incremented, the cameras read it right after each grab
+class TriggerClock:
+    def __init__(self, fps: float) -> None:
+        self.period = 1.0 / fps
+        self.tick = -1
+        self.running = True
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    def run(self):
+        start = timeit.default_timer()
+        n = 0
+        while self.running:
+            # fixed schedule: late ticks do not shift the following ones
+            wait = start + n * self.period - timeit.default_timer()
+            if wait > 0:
+                time.sleep(wait)
+            with self.lock:
+                self.tick = n
+            n += 1
+    # newest tick, without waiting (None once stopped)
+    def current(self) -> int | None:
+        with self.lock:
+            return self.tick if self.running else None
+    def stop(self):
+        with self.lock:
+            self.running = False
+        self.thread.join()
+
+
+# collect the instants at which each camera grabbed each tick, to
+# measure the skew between cameras
+class SkewRecorder:
+    def __init__(self, cameras: int) -> None:
+        self.lock = threading.Lock()
+        # per camera: tick => timeit.default_timer() of the grab
+        self.grabs = [dict() for _ in range(cameras)]
+    def record(self, camera: int, tick: int, t: float):
+        with self.lock:
+            self.grabs[camera][tick] = t
+    # ticks grabbed by all the cameras and relative grab instants, as
+    # (ticks, times) with times[i, c] = grab time of camera c at ticks[i]
+    def common_grabs(self, last: int | None = None):
+        with self.lock:
+            common = set(self.grabs[0].keys())
+            for g in self.grabs[1:]:
+                common &= g.keys()
+            ticks = np.array(sorted(common), dtype=np.int64)
+            if last is not None:
+                ticks = ticks[-last:]
+            times = np.array([[g[t] for g in self.grabs] for t in ticks], dtype=np.float64).reshape(len(ticks), len(self.grabs))
+        return ticks, times
+    # skew (seconds) between first and last camera for each common tick
+    def skews(self, last: int | None = None):
+        ticks, times = self.common_grabs(last)
+        if len(ticks) == 0:
+            return ticks, np.zeros(0)
+        return ticks, times.max(axis=1) - times.min(axis=1)
+
+
+# camera captured synchronously with the others: frames are grabbed
+# continuously (only the grab, no decoding), so that the buffers of the
+# camera (V4L2, FFmpeg) never hand back old frames. The first frame
+# grabbed after a tick of the clock is decoded with retrieve() and handed
+# to sink(tick, datetime, frame), its grab instant is recorded to measure
+# the skew. A slow camera just misses ticks (which are counted) without
+# blocking the others.
+class SyncCamera:
+    def __init__(self, index: int, vcap, clock: TriggerClock, skew: SkewRecorder, sink) -> None:
+        self.index = index
+        self.vcap = vcap
+        self.clock = clock
+        self.skew = skew
+        self.sink = sink
+        self.frames = 0
+        self.missed = 0
+        self.failed = False
+        # last retrieved frame (for display)
+        self.latest = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    def run(self):
+        last = -1
+        while True:
+            if not self.vcap.grab():
+                self.failed = True
+                return
+            t = timeit.default_timer()
+            now = datetime.datetime.now()
+            tick = self.clock.current()
+            if tick is None:
+                return
+            if tick <= last:
+                # no new tick: the frame is discarded without decoding
+                continue
+            if last >= 0:
+                self.missed += tick - last - 1
+            last = tick
+            self.skew.record(self.index, tick, t)
+            ret, frame = self.vcap.retrieve()
+            if not ret:
+                continue
+            self.frames += 1
+            self.latest = frame
+            self.sink(tick, now, frame)
+    def join(self):
+        self.thread.join()
+
+
+# seconds to wait before reopening a stream after an error
+RECONNECT_DELAY = 1.0
+# seconds LatestFrameReader.read waits for a new frame
+READ_TIMEOUT = 2.0
+
+# low latency reader of (network) streams: a background thread drains
+# the stream continuously, so the FFmpeg buffer never grows, and keeps
+# only the newest decoded frame together with its arrival time. Frames
+# replaced before being read are counted as dropped. On errors the
+# stream is reopened. read() mimics cv2.VideoCapture.read.
+class LatestFrameReader:
+    def __init__(self, source, api=cv2.CAP_FFMPEG, reconnect_delay=RECONNECT_DELAY, read_timeout=READ_TIMEOUT) -> None:
+        self.source = source
+        self.api = api
+        self.reconnect_delay = reconnect_delay
+        self.read_timeout = read_timeout
+        self.vcap = None
+        self.cond = threading.Condition()
+        self.frame = None
+        # arrival time (timeit.default_timer) of the frame
+        self.timestamp = None
+        # sequence number of the newest frame and of the last one read
+        self.seq = 0
+        self.served_seq = 0
+        self.received = 0
+        self.dropped = 0
+        self.reconnects = 0
+        # delay between arrival and read of the last frame read
+        self.lag = None
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    def open(self) -> bool:
+        if self.vcap is not None:
+            self.vcap.release()
+        self.vcap = cv2.VideoCapture(self.source, self.api)
+        return self.vcap.isOpened()
+    def run(self):
+        opened = self.open()
+        while self.running:
+            ret, frame = self.vcap.read() if opened else (False, None)
+            if not ret:
+                time.sleep(self.reconnect_delay)
+                if not self.running:
+                    break
+                self.reconnects += 1
+                opened = self.open()
+                continue
+            arrival = timeit.default_timer()
+            with self.cond:
+                if self.seq > self.served_seq:
+                    self.dropped += 1
+                self.frame = frame
+                self.timestamp = arrival
+                self.seq += 1
+                self.received += 1
+                self.cond.notify_all()
+        self.vcap.release()
+    # wait for a frame newer than the last one read and return it as
+    # (frame, arrival time), (None, None) on timeout
+    def latest(self, timeout=None):
+        if timeout is None:
+            timeout = self.read_timeout
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.seq > self.served_seq or not self.running, timeout=timeout):
+                return None, None
+            if not self.running:
+                return None, None
+            self.served_seq = self.seq
+            self.lag = timeit.default_timer() - self.timestamp
+            return self.frame, self.timestamp
+    def read(self):
+        frame, _ = self.latest()
+        return frame is not None, frame
+    def statistics(self) -> dict:
+        with self.cond:
+            return {
+                "received": self.received,
+                "dropped": self.dropped,
+                "reconnects": self.reconnects,
+                "lag (s)": self.lag,
+            }
+    def release(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
@@ -0,0 +1,417 @@
+import numpy as np
+import cv2 as cv
+import os
+import timeit
+import itertools
+import hashlib
+import threading
+import queue
+import concurrent.futures
+
+# Tutorial:
+#   https://docs.opencv.org/4.x/dc/dbb/tutorial_py_calibration.html
+
+# default termination criteria for cv.cornerSubPix
+SUBPIX_CRITERIA = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+# prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
+def chessboard_object_points(ROWS, COLS):
+    objp = np.zeros((ROWS*COLS,3), np.float32)
+    objp[:,:2] = np.mgrid[0:COLS,0:ROWS].T.reshape(-1,2)
+    return objp
+
+# look for the chessboard inside a grayscale image, return the refined
+# corners (or None if the board was not found)
+#   pyramid_levels  =>  coarse-to-fine search: the board is searched on
+#                       a copy downscaled (cv.pyrDown) this many times,
+#                       corners are then refined at full resolution
+#   fast_check      =>  use CALIB_CB_FAST_CHECK to quickly reject
+#                       pictures not containing any board
+#   refine          =>  refine corners with cv.cornerSubPix
+def find_chessboard(gray, ROWS, COLS, criteria=SUBPIX_CRITERIA, pyramid_levels=0, fast_check=False, refine=True):
+    # default flags of cv.findChessboardCorners
+    flags = cv.CALIB_CB_ADAPTIVE_THRESH + cv.CALIB_CB_NORMALIZE_IMAGE
+    if fast_check:
+        flags += cv.CALIB_CB_FAST_CHECK
+    small = gray
+    for _ in range(pyramid_levels):
+        small = cv.pyrDown(small)
+    ret, corners = cv.findChessboardCorners(small, (COLS,ROWS), None, flags)
+    if not ret:
+        return None
+    if pyramid_levels:
+        # pixel (x,y) of a pyrDown output comes from pixel (2x,2y)
+        corners = corners * float(2 ** pyramid_levels)
+    if not refine:
+        return corners
+    return cv.cornerSubPix(gray, corners, (11,11), (-1,-1), criteria)
+
+# load a picture and look for the chessboard inside it, the result is
+# a dictionary:
+#   path    =>  path of the image
+#   found   =>  was the chessboard found?
+#   corners =>  refined corners (None if not found)
+#   shape   =>  (width, height) of the image ((0, 0) if it cannot
+#               be decoded, the chessboard is not found)
+#   time    =>  seconds spent on the image
+#   cached  =>  was the result taken from a CornersCache?
+def detect_chessboard_file(fname, ROWS, COLS, criteria=SUBPIX_CRITERIA, pyramid_levels=0, fast_check=False):
+    start = timeit.default_timer()
+    img = cv.imread(fname)
+    if img is None:
+        return {
+            "path": fname,
+            "found": False,
+            "corners": None,
+            "shape": (0, 0),
+            "time": timeit.default_timer() - start,
+            "cached": False,
+        }
+    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+    corners = find_chessboard(gray, ROWS, COLS, criteria, pyramid_levels=pyramid_levels, fast_check=fast_check)
+    return {
+        "path": fname,
+        "found": corners is not None,
+        "corners": corners,
+        "shape": gray.shape[::-1],
+        "time": timeit.default_timer() - start,
+        "cached": False,
+    }
+
+# name of the file caching the detection results (inside the
+# directory containing the calibration pictures)
+CORNERS_CACHE_FILE = "corners_cache.npz"
+
+# on-disk cache of the detection results, the same picture (same content)
+# searched for the same chessboard with the same criteria is never
+# processed twice. Pictures are hashed only when their size or mtime
+# changed since the last time they were seen.
+class CornersCache:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.basedir = os.path.dirname(os.path.abspath(path))
+        # detection key => (found, (width, height), corners)
+        self.entries = {}
+        # relative path => ((size, mtime_ns), content hash)
+        self.hashes = {}
+        self.changed = False
+        if os.path.exists(path):
+            self.load()
+    def load(self):
+        with np.load(self.path) as data:
+            offsets = data["offsets"]
+            corners = data["corners"]
+            for i, key in enumerate(data["keys"]):
+                found = bool(data["found"][i])
+                pts = corners[offsets[i]:offsets[i+1]].reshape(-1,1,2) if found else None
+                self.entries[str(key)] = (found, tuple(map(int, data["shapes"][i])), pts)
+            for relpath, sig, digest in zip(data["stat_paths"], data["stat_sig"], data["stat_hash"]):
+                self.hashes[str(relpath)] = (tuple(map(int, sig)), str(digest))
+    # store the cache (atomically, to survive interrupted runs)
+    def save(self):
+        if not self.changed:
+            return
+        keys = list(self.entries.keys())
+        found = np.array([self.entries[k][0] for k in keys], dtype=bool)
+        shapes = np.array([self.entries[k][1] for k in keys], dtype=np.int64).reshape(-1,2)
+        pts = [self.entries[k][2].reshape(-1,2) if self.entries[k][0] else np.zeros((0,2), np.float32) for k in keys]
+        offsets = np.zeros(len(keys)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(p) for p in pts])
+        corners = np.concatenate(pts).astype(np.float32) if pts else np.zeros((0,2), np.float32)
+        relpaths = list(self.hashes.keys())
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as f:
+            np.savez(f, keys=np.array(keys, dtype=str), found=found, shapes=shapes,
+                offsets=offsets, corners=corners,
+                stat_paths=np.array(relpaths, dtype=str),
+                stat_sig=np.array([self.hashes[p][0] for p in relpaths], dtype=np.int64).reshape(-1,2),
+                stat_hash=np.array([self.hashes[p][1] for p in relpaths], dtype=str))
+        os.replace(tmp, self.path)
+        self.changed = False
+    # hash of the content of the picture
+    def image_hash(self, fname) -> str:
+        st = os.stat(fname)
+        sig = (st.st_size, st.st_mtime_ns)
+        relpath = os.path.relpath(os.path.abspath(fname), self.basedir)
+        known = self.hashes.get(relpath)
+        if known is not None and known[0] == sig:
+            return known[1]
+        h = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        self.hashes[relpath] = (sig, h.hexdigest())
+        self.changed = True
+        return h.hexdigest()
+    # key identifying a detection: picture content, board size, criteria
+    # and detection mode (a coarse search may miss some boards)
+    def key(self, fname, ROWS, COLS, criteria=SUBPIX_CRITERIA, pyramid_levels=0, fast_check=False) -> str:
+        key = f"{self.image_hash(fname)}-{ROWS}x{COLS}-{'_'.join(map(str, criteria))}"
+        if pyramid_levels or fast_check:
+            key += f"-L{pyramid_levels}{'F' if fast_check else ''}"
+        return key
+    # get a cached detection result (None if missing)
+    def get(self, key, fname) -> dict | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        found, shape, corners = entry
+        return {
+            "path": fname,
+            "found": found,
+            "corners": corners,
+            "shape": shape,
+            "time": 0.0,
+            "cached": True,
+        }
+    def put(self, key, result: dict):
+        self.entries[key] = (result["found"], tuple(result["shape"]), result["corners"])
+        self.changed = True
+
+
+# detect the chessboard inside all the given images, results are in the
+# same order of 'images'
+#   workers         =>  size of the pool (None: one per CPU, <= 1: serial)
+#   use_processes   =>  use a pool of processes instead of threads
+#   cache           =>  (optional) CornersCache, only missing pictures
+#                       are processed
+#   pyramid_levels, fast_check  =>  see find_chessboard
+def detect_chessboards(images, ROWS, COLS, criteria=SUBPIX_CRITERIA, workers=None, use_processes=False, cache: CornersCache | None = None, pyramid_levels=0, fast_check=False) -> list[dict]:
+    results = [None] * len(images)
+    keys = [None] * len(images)
+    if cache is not None:
+        for idx, fname in enumerate(images):
+            keys[idx] = cache.key(fname, ROWS, COLS, criteria, pyramid_levels=pyramid_levels, fast_check=fast_check)
+            results[idx] = cache.get(keys[idx], fname)
+    # pictures still to be processed
+    missing = [idx for idx, r in enumerate(results) if r is None]
+    to_process = [images[idx] for idx in missing]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(to_process) <= 1:
+        detected = [detect_chessboard_file(fname, ROWS, COLS, criteria, pyramid_levels, fast_check) for fname in to_process]
+    else:
+        # OpenCV releases the GIL, so threads are usually enough
+        if use_processes:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        with executor:
+            detected = list(executor.map(detect_chessboard_file, to_process,
+                itertools.repeat(ROWS), itertools.repeat(COLS), itertools.repeat(criteria),
+                itertools.repeat(pyramid_levels), itertools.repeat(fast_check)))
+
+    for idx, r in zip(missing, detected):
+        results[idx] = r
+        if cache is not None:
+            cache.put(keys[idx], r)
+    if cache is not None:
+        cache.save()
+    return results
+
+# print a short summary about the detection results
+def detection_summary(results: list[dict]):
+    found = sum(map(lambda r: r["found"], results))
+    cpu_time = sum(map(lambda r: r["time"], results))
+    cached = sum(map(lambda r: r["cached"], results))
+    print(f"Chessboard found in {found}/{len(results)} images (detection time: {cpu_time:.3f}s, {cached} cached)")
+
+# put together the points to be passed to cv.calibrateCamera and
+# calculate the calibration
+def calibrate_from_detections(results: list[dict], ROWS, COLS):
+    objp = chessboard_object_points(ROWS, COLS)
+    # Arrays to store object points and image points from all the images.
+    objpoints = [] # 3d point in real world space
+    imgpoints = [] # 2d points in image plane.
+    shape = None
+    for r in results:
+        if r["found"]:
+            objpoints.append(objp)
+            imgpoints.append(r["corners"])
+            shape = r["shape"]
+    if shape is None:
+        raise ValueError("Chessboard not found in any image, cannot calibrate")
+    # Doc:
+    #  https://docs.opencv.org/4.x/d9/d0c/group__calib3d.html#ga3207604e4b1a1758aa66acb6ed5aa65d
+    ret, mtx, dist, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, shape, None, None)
+    return (ret, mtx, dist, rvecs, tvecs)
+
+
+# background chessboard detector for live previews: the capture loop
+# submits its frames without ever blocking, a worker thread runs a fast
+# (coarse, unrefined) detection on the most recent one only and keeps
+# the last result available to be drawn
+class BoardDetector:
+    def __init__(self, ROWS, COLS, pyramid_levels=1, fast_check=True) -> None:
+        self.ROWS = ROWS
+        self.COLS = COLS
+        self.pyramid_levels = pyramid_levels
+        self.fast_check = fast_check
+        self.cond = threading.Condition()
+        # (timestamp, frame) waiting to be processed, older frames
+        # still waiting are simply replaced
+        self.pending = None
+        # (timestamp, corners) of the last processed frame
+        self.result = None
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    # timestamp: time (timeit.default_timer) the frame was captured at
+    def submit(self, timestamp: float, frame):
+        with self.cond:
+            self.pending = (timestamp, frame)
+            self.cond.notify()
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and self.pending is None:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                timestamp, frame = self.pending
+                self.pending = None
+            gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+            corners = find_chessboard(gray, self.ROWS, self.COLS, pyramid_levels=self.pyramid_levels, fast_check=self.fast_check, refine=False)
+            with self.cond:
+                self.result = (timestamp, corners)
+    # last result as (timestamp, corners), None if no frame processed yet
+    def get_result(self):
+        with self.cond:
+            return self.result
+    # was the board visible in a frame captured at most max_age seconds
+    # before now?
+    def board_visible(self, now: float, max_age: float) -> bool:
+        result = self.get_result()
+        return result is not None and result[1] is not None and now - result[0] <= max_age
+    # draw the last result on the given image
+    def draw(self, img):
+        result = self.get_result()
+        if result is not None and result[1] is not None:
+            cv.drawChessboardCorners(img, (self.COLS,self.ROWS), result[1], True)
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+
+# incremental calibration: accepted frames are sent to a worker thread
+# which detects the board, adds the view to the calibration set and
+# solves the intrinsics again (starting from the previous solution),
+# reporting the RMS and per-view reprojection errors.
+# Calibration is considered converged when the RMS changed less than
+# 'tolerance' (relative) for 'patience' consecutive solutions, or when
+# 'max_views' views have been collected.
+# views needed before the first solution
+INCREMENTAL_MIN_VIEWS = 5
+
+class IncrementalCalibrator:
+    def __init__(self, ROWS, COLS, min_views=INCREMENTAL_MIN_VIEWS, max_views=None, tolerance=0.01, patience=3, criteria=SUBPIX_CRITERIA, pyramid_levels=0, fast_check=False) -> None:
+        self.ROWS = ROWS
+        self.COLS = COLS
+        # with fewer views allowed, solve once all of them are collected
+        self.min_views = min_views if max_views is None else min(min_views, max_views)
+        self.max_views = max_views
+        self.tolerance = tolerance
+        self.patience = patience
+        self.criteria = criteria
+        self.pyramid_levels = pyramid_levels
+        self.fast_check = fast_check
+        self.objp = chessboard_object_points(ROWS, COLS)
+        # Arrays to store object points and image points from all the views.
+        self.objpoints = []
+        self.imgpoints = []
+        self.shape = None
+        self.lock = threading.Lock()
+        # (ret, mtx, dist, rvecs, tvecs) of the last solution
+        self.solution = None
+        self.per_view_errors = None
+        # RMS of each solution
+        self.history = []
+        self.converged = False
+        self.frames = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    # queue a frame to be used for calibration (never blocks)
+    def add_frame(self, frame):
+        self.frames.put(frame)
+    def run(self):
+        stop = False
+        while not stop:
+            frames = [self.frames.get()]
+            # take all the frames queued meanwhile, solve only once
+            while not self.frames.empty():
+                frames.append(self.frames.get())
+            added = 0
+            for frame in frames:
+                if frame is None:
+                    stop = True
+                elif self.add_view(frame):
+                    added += 1
+            if added and len(self.objpoints) >= self.min_views and not self.converged:
+                self.solve()
+    # detect the board inside the frame and add it to the calibration set
+    def add_view(self, frame) -> bool:
+        if self.max_views is not None and len(self.objpoints) >= self.max_views:
+            return False
+        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        corners = find_chessboard(gray, self.ROWS, self.COLS, self.criteria, pyramid_levels=self.pyramid_levels, fast_check=self.fast_check)
+        if corners is None:
+            print("Incremental calibration: chessboard not found, view discarded")
+            return False
+        self.objpoints.append(self.objp)
+        self.imgpoints.append(corners)
+        self.shape = gray.shape[::-1]
+        return True
+    def solve(self):
+        mtx, dist, flags = None, None, 0
+        if self.solution is not None:
+            mtx = self.solution[1].copy()
+            dist = self.solution[2].copy()
+            flags = cv.CALIB_USE_INTRINSIC_GUESS
+        start = timeit.default_timer()
+        try:
+            ret, mtx, dist, rvecs, tvecs, _, _, per_view_errors = cv.calibrateCameraExtended(self.objpoints, self.imgpoints, self.shape, mtx, dist, flags=flags)
+        except cv.error as e:
+            if not flags:
+                print("Incremental calibration: cannot solve calibration:", e)
+                return
+            # previous solution is not a valid guess, start from scratch
+            ret, mtx, dist, rvecs, tvecs, _, _, per_view_errors = cv.calibrateCameraExtended(self.objpoints, self.imgpoints, self.shape, None, None)
+        elapsed = timeit.default_timer() - start
+        with self.lock:
+            self.solution = (ret, mtx, dist, rvecs, tvecs)
+            self.per_view_errors = per_view_errors.ravel()
+            self.history.append(ret)
+            self.converged = self.has_converged()
+        self.report(elapsed)
+    def has_converged(self) -> bool:
+        if self.max_views is not None and len(self.objpoints) >= self.max_views:
+            return True
+        if len(self.history) <= self.patience:
+            return False
+        last = np.array(self.history[-(self.patience+1):])
+        changes = np.abs(np.diff(last)) / last[1:]
+        return bool(np.all(changes < self.tolerance))
+    def report(self, elapsed: float):
+        views = len(self.objpoints)
+        print(f"Incremental calibration [{views} views]: RMS reprojection error {self.history[-1]:.4f} ({elapsed:.3f}s)")
+        print("\t", "per-view errors:", np.array2string(self.per_view_errors, precision=3))
+        print("\t", "worst view:", int(np.argmax(self.per_view_errors)))
+        if self.converged:
+            print("\t", "CONVERGED")
+        print()
+    # (views, last RMS or None, converged)
+    def status(self):
+        with self.lock:
+            rms = self.history[-1] if self.history else None
+            return len(self.objpoints), rms, self.converged
+    # last solution as (ret, mtx, dist, rvecs, tvecs), None if missing
+    def get_solution(self):
+        with self.lock:
+            return self.solution
+    # wait for the queued frames to be processed and stop the worker
+    def stop(self):
+        self.frames.put(None)
+        self.thread.join()
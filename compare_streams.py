@@ -3,11 +3,18 @@
 
 # rely on functions defined by analize_stream
 from analize_stream import *
+from stream_storage import read_impairments
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument("streamdir_1", help="Directory containing the first stread")
 parser.add_argument("streamdir_2", help="Directory containing the secpmd stread")
+parser.add_argument("-a", "--align", dest="align", default="picnum", choices=["picnum", "time"], help="Match frames by picture number or by nearest capture time (after removing the estimated clock offset)")
+parser.add_argument("-t", "--tolerance", dest="tolerance", default=None, type=float, help="(time alignment) Max distance (ms) of matched frames, default: half of the median inter-arrival time")
+parser.add_argument("--max-offset", dest="max_offset", default=10000.0, type=float, help="Max clock offset (ms) searched")
+parser.add_argument("-r", "--report", dest="report", default=None, help="Where to store the JSON report")
+parser.add_argument("-s", "--save", dest="save", nargs='+', default=None, help="Store the plots inside the given files instead of showing them")
+parser.add_argument("--plot", dest="plot", default=True, action=argparse.BooleanOptionalAction, help="Plot the delay differences")
 parser.add_argument("-v", "--verbose", dest="verbose", default=False, action=argparse.BooleanOptionalAction, help="Output vebose")
 
 def parse():
@@ -16,14 +23,291 @@ def parse():
         print_err(f"ERROR: missing directory '{args.streamdir_1}'")
     if not os.path.exists(args.streamdir_2):
         print_err(f"ERROR: missing directory '{args.streamdir_2}'")
-    return args.streamdir_1, args.streamdir_2, args.verbose
+    options = {"align": args.align, "tolerance": args.tolerance, "max_offset": args.max_offset}
+    return args.streamdir_1, args.streamdir_2, options, args.report, args.save, args.plot, args.verbose
 
+# frames of the two streams having the same picture number, as indexes
+# inside the two arrays
+def align_by_picnum(picnums_1, picnums_2):
+    _, idx_1, idx_2 = np.intersect1d(picnums_1, picnums_2, assume_unique=False, return_indices=True)
+    return idx_1, idx_2
+
+# match each frame of the second stream with the frame of the first one
+# captured closest in time (times in int64 us), pairs more distant than
+# tolerance are discarded and each frame is used at most once
+def align_by_time(times_1, times_2, tolerance: int):
+    order = np.argsort(times_1, kind="stable")
+    sorted_1 = times_1[order]
+    pos = np.searchsorted(sorted_1, times_2)
+    before = np.clip(pos - 1, 0, len(sorted_1) - 1)
+    after = np.clip(pos, 0, len(sorted_1) - 1)
+    nearest = np.where(np.abs(times_2 - sorted_1[before]) <= np.abs(sorted_1[after] - times_2), before, after)
+    distance = np.abs(times_2 - sorted_1[nearest])
+    candidates = np.flatnonzero(distance <= tolerance)
+    # closest pairs first, then keep the first pair of every frame
+    candidates = candidates[np.argsort(distance[candidates], kind="stable")]
+    _, first = np.unique(nearest[candidates], return_index=True)
+    idx_2 = np.sort(candidates[first])
+    return order[nearest[idx_2]], idx_2
+
+# below this correlation coefficient the inter-arrival patterns of the
+# two streams are considered unrelated
+MIN_CORRELATION = 0.3
+# resolution (us) of the arrival patterns correlated to find the offset
+ARRIVAL_RESOLUTION = 1000
+# the arrival patterns are correlated over at most this many bins, the
+# resolution is lowered when needed
+MAX_CORRELATION_BINS = 1 << 22
+# min prominence (in standard deviations) of the arrival correlation peak
+MIN_PROMINENCE = 10.0
+# an arrival correlation peak disagreeing with the inter-arrival estimate
+# is kept only if at least this fraction of the frames match once shifted
+MIN_MATCH_RATIO = 0.9
+# min prominence (in standard deviations) of an inter-arrival correlation
+# peak shifting the frames, weaker peaks are noise (e.g. of random
+# delays) and the frames are matched in order
+MIN_LAG_PROMINENCE = 5.0
+
+# distance of each time of times_2 from the closest one of the sorted
+# times_1
+def nearest_distance(sorted_1, times_2) -> np.ndarray:
+    pos = np.searchsorted(sorted_1, times_2)
+    before = sorted_1[np.clip(pos - 1, 0, len(sorted_1) - 1)]
+    after = sorted_1[np.clip(pos, 0, len(sorted_1) - 1)]
+    return np.where(np.abs(times_2 - before) <= np.abs(after - times_2), times_2 - before, times_2 - after)
+
+# offset (us) maximizing the cross correlation of the frame arrival
+# patterns (frames counted per bin), refined matching each frame with
+# the closest one. Lost frames do not matter, but random delays destroy
+# the patterns: None if the correlation peak is not prominent
+def arrival_offset(times_1, times_2, max_offset: int) -> int | None:
+    start = min(times_1[0], times_2[0])
+    span = max(times_1[-1], times_2[-1]) - start
+    resolution = max(ARRIVAL_RESOLUTION, int(span // MAX_CORRELATION_BINS) + 1)
+    bins = int(span // resolution) + 1
+    trains = [np.bincount((t - start) // resolution, minlength=bins).astype(np.float64) for t in (times_1, times_2)]
+    trains = [t - t.mean() for t in trains]
+    # zero padding, to have a linear (not circular) correlation
+    size = 1 << int(2 * bins - 1).bit_length()
+    correlation = np.fft.irfft(np.fft.rfft(trains[1], size) * np.conj(np.fft.rfft(trains[0], size)), size)
+    # far lags overlap few frames, their peaks are noise: the true offset
+    # has to leave at least half of the streams overlapping
+    max_lag = min(max_offset // resolution, bins // 2)
+    lags = np.arange(-max_lag, max_lag + 1)
+    correlation = correlation[lags]
+    best = int(np.argmax(correlation))
+    if correlation.std() == 0 or (correlation[best] - correlation.mean()) / correlation.std() < MIN_PROMINENCE:
+        return None
+    offset = int(lags[best]) * resolution
+    return int(offset + np.median(nearest_distance(times_1, times_2 - offset)))
+
+# offset (us) found cross correlating the sequences of inter-arrival
+# times, to know how many frames the second stream is shifted by, the
+# offset is the median distance of the frames once shifted. Works with
+# random delays as long as frames are not lost
+def inter_arrival_offset(times_1, times_2, max_offset: int) -> int:
+    inter_1, inter_2 = [np.diff(t).astype(np.float64) for t in (times_1, times_2)]
+    period = max(float(np.median(inter_1)), 1.0)
+    inter_1 -= inter_1.mean()
+    inter_2 -= inter_2.mean()
+    # zero padding, to have a linear (not circular) correlation
+    size = 1 << int(len(inter_1) + len(inter_2)).bit_length()
+    correlation = np.fft.irfft(np.fft.rfft(inter_2, size) * np.conj(np.fft.rfft(inter_1, size)), size)
+    # correlation[k] = sum(inter_2[i + k] * inter_1[i]), negative lags wrap,
+    # normalized by the number of overlapping samples. Far lags overlap few
+    # samples and their noise would win: at least half of the shorter
+    # sequence has to overlap
+    max_lag = int(min(max_offset / period, min(len(inter_1), len(inter_2)) // 2))
+    lags = np.arange(-max_lag, max_lag + 1)
+    overlap = np.minimum(len(inter_2) - lags, len(inter_1)) - np.maximum(0, -lags)
+    coefficients = correlation[lags] / overlap / max(inter_1.std() * inter_2.std(), 1e-9)
+    best = int(np.argmax(coefficients))
+    if lags[best] != 0 and coefficients[best] - coefficients.mean() < MIN_LAG_PROMINENCE * coefficients.std():
+        best = max_lag
+    # patterns destroyed by random delays (or peak not above the noise of
+    # short streams): frames are matched in order when none is lost,
+    # otherwise with the closest ones
+    significant = max(MIN_CORRELATION, 3 / np.sqrt(overlap[best]))
+    if coefficients[best] < significant and len(times_1) != len(times_2):
+        return int(np.median(nearest_distance(times_1, times_2)))
+    lag = int(lags[best]) if coefficients[best] >= significant else 0
+    # frames of the two streams matched once shifted
+    first = max(0, -lag)
+    count = min(len(times_1) - first, len(times_2) - first - lag)
+    return int(np.median(times_2[first+lag:first+lag+count] - times_1[first:first+count]))
+
+# fraction of the frames of times_2 which, moved back by offset, are
+# within tolerance of a frame of the (sorted) times_1
+def match_ratio(sorted_1, times_2, offset: int, tolerance: float) -> float:
+    return float(np.mean(np.abs(nearest_distance(sorted_1, times_2 - offset)) <= tolerance))
+
+# estimate how much (us) the second stream is late with respect to the
+# first one from the inter-arrival patterns, refined with the arrival
+# patterns when they survived. Random delays can produce spurious
+# arrival peaks: the arrival estimate is used only when it agrees with
+# the inter-arrival one or when (e.g. lost frames confused the
+# inter-arrival one) almost all the frames match with it, and more than
+# with the inter-arrival one
+def estimate_clock_offset(times_1, times_2, max_offset: int) -> int:
+    times_1, times_2 = np.sort(times_1), np.sort(times_2)
+    if min(len(times_1), len(times_2)) < 3:
+        return int(np.median(times_2) - np.median(times_1))
+    reference = inter_arrival_offset(times_1, times_2, max_offset)
+    offset = arrival_offset(times_1, times_2, max_offset)
+    if offset is None:
+        return reference
+    tolerance = float(np.median(np.diff(times_1))) / 4
+    if abs(offset - reference) <= tolerance:
+        return offset
+    ratio = match_ratio(times_1, times_2, offset, tolerance)
+    if ratio >= MIN_MATCH_RATIO and ratio > match_ratio(times_1, times_2, reference, tolerance):
+        return offset
+    return reference
+
+# comparison of two stream indexes (see stream_index.load_stream_index)
+# returns the report and the per frame delay differences (us)
+def compare_indexes(index_1: dict, index_2: dict, align="picnum", tolerance=None, max_offset=10000.0):
+    times_1 = index_1["picTime"].astype(np.int64)
+    times_2 = index_2["picTime"].astype(np.int64)
+    offset = estimate_clock_offset(times_1, times_2, int(max_offset * 1000))
+    if align == "picnum":
+        idx_1, idx_2 = align_by_picnum(index_1["picNum"], index_2["picNum"])
+    else:
+        if tolerance is None:
+            tolerance = np.median(np.diff(pic_times_us(times_1.astype("datetime64[us]")))) / 2000.0
+        idx_1, idx_2 = align_by_time(times_1, times_2 - offset, int(tolerance * 1000))
+    # follow the order of the first stream
+    order = np.argsort(times_1[idx_1], kind="stable")
+    idx_1, idx_2 = idx_1[order], idx_2[order]
+    delays = times_2[idx_2] - times_1[idx_1]
+    # frames of the second stream not in the same order as in the first
+    reordered = int(np.count_nonzero(np.diff(times_2[idx_2]) < 0))
+    report = {
+        "stream_1": index_1["streamName"],
+        "stream_2": index_2["streamName"],
+        "align": align,
+        "frames_1": int(len(times_1)),
+        "frames_2": int(len(times_2)),
+        "matched": int(len(delays)),
+        "unmatched_1": int(len(times_1) - len(delays)),
+        "unmatched_2": int(len(times_2) - len(delays)),
+        "reordered": reordered,
+        "clockOffsetMs": offset / 1000.0,
+        "delay": describe_us(delays),
+    }
+    if align == "time":
+        report["toleranceMs"] = float(tolerance)
+    return report, index_1["picNum"][idx_1], delays
+
+# position of each frame (by picture number) in the order expected
+# without reordering: the picture number itself or, when the delays
+# added to the frames are known (see stream_storage.IMPAIRMENTS_FILE),
+# the capture time in the first stream plus the added delay, so that
+# frames overtaken because of random delays are not reordered ones
+def expected_order(index_1: dict, picnums, impairments: dict | None = None) -> np.ndarray:
+    if impairments is None or "addedDelay" not in impairments:
+        return np.asarray(picnums)
+    order_1 = np.argsort(index_1["picNum"], kind="stable")
+    nums_1 = index_1["picNum"][order_1]
+    times_1 = index_1["picTime"].astype(np.int64)[order_1]
+    order_d = np.argsort(impairments["delayPicNum"], kind="stable")
+    nums_d = impairments["delayPicNum"][order_d]
+    delays = np.round(impairments["addedDelay"][order_d] * 1000).astype(np.int64)
+    pos_1 = np.clip(np.searchsorted(nums_1, picnums), 0, len(nums_1) - 1)
+    pos_d = np.clip(np.searchsorted(nums_d, picnums), 0, len(nums_d) - 1)
+    return times_1[pos_1] + delays[pos_d]
+
+# picture numbers of the frames lost, reordered (delivered after a frame
+# expected later, see expected_order) and duplicated by the second stream
+def detect_impairments(index_1: dict, index_2: dict, impairments: dict | None = None) -> dict:
+    picnums_2 = index_2["picNum"][np.argsort(index_2["picTime"], kind="stable")]
+    numbers, counts = np.unique(picnums_2, return_counts=True)
+    expected = expected_order(index_1, picnums_2, impairments)
+    latest = np.maximum.accumulate(expected)
+    return {
+        "lost": np.setdiff1d(index_1["picNum"], picnums_2),
+        "reordered": np.unique(picnums_2[1:][expected[1:] < latest[:-1]]),
+        "duplicated": numbers[counts > 1],
+    }
+
+# compare the impairments applied to a stream (see
+# stream_storage.read_impairments) with the ones detected
+def score_impairments(index_1: dict, index_2: dict, impairments: dict) -> dict:
+    detected = detect_impairments(index_1, index_2, impairments)
+    score = {"parameters": impairments["parameters"]}
+    for kind, found in detected.items():
+        expected = np.unique(impairments[kind])
+        matched = len(np.intersect1d(expected, found))
+        score[kind] = {
+            "expected": int(len(expected)),
+            "detected": int(len(found)),
+            "matched": matched,
+            "precision": matched / len(found) if len(found) else 1.0,
+            "recall": matched / len(expected) if len(expected) else 1.0,
+        }
+    return score
+
+# delay of each matched frame and distribution of the delays
+def plot_delays(picnums, delays, title: str | None = None):
+    import matplotlib.pyplot as plt
+    delays_ms = delays / 1000.0
+    fig, (ax0, ax1) = plt.subplots(1, 2, figsize=(12, 4))
+    ax0.plot(picnums, delays_ms)
+    ax0.set_xlabel("picNum")
+    ax0.set_ylabel("delay (ms)")
+    ax1.hist(delays_ms, bins=100)
+    ax1.set_xlabel("delay (ms)")
+    if title:
+        fig.suptitle(title)
+    return fig
 
 
 def main():
-    streamdir_1, streamdir_2, verbose = parse()
+    streamdir_1, streamdir_2, options, reportfile, save, plot, verbose = parse()
+
+    try:
+        index_1 = load_stream_index(streamdir_1)
+        index_2 = load_stream_index(streamdir_2)
+    except ValueError as e:
+        print_err(e)
+
+    report, picnums, delays = compare_indexes(index_1, index_2, **options)
+    # streams generated by add_latency_to_stream know their impairments
+    impairments = read_impairments(streamdir_2)
+    if impairments is not None:
+        report["impairments"] = score_impairments(index_1, index_2, impairments)
+    if len(delays) == 0:
+        print_err("ERROR: no frame of the two streams could be matched")
+
+    print("Result of the comparison:")
+    if verbose:
+        pp =  pprint.PrettyPrinter(depth=4)
+        pp.pprint(report)
+    else:
+        print('\t', "frames", '\t=>', f'{report["frames_1"]} / {report["frames_2"]}')
+        print('\t', "matched", '\t=>', report["matched"])
+        print('\t', "reordered", '\t=>', report["reordered"])
+        print('\t', "clock offset (ms)", '\t=>', report["clockOffsetMs"])
+        print('\t', "delay (ms)", '\t=>', ", ".join(f"{k} {v:.3f}" for k, v in report["delay"].items()))
+        if impairments is not None:
+            print('\t', "impairments", '\t=>', report["impairments"]["parameters"])
+            for kind in ["lost", "reordered", "duplicated"]:
+                print('\t\t', kind, '\t=>', ", ".join(f"{k} {v:.3f}" if isinstance(v, float) else f"{k} {v}" for k, v in report["impairments"][kind].items()))
+    if reportfile:
+        store_report(report, reportfile)
+        print(f"Report stored inside '{reportfile}'")
 
-    metadata = get_stream_metadata(streamdir_1)
-    metadata = get_stream_metadata(streamdir_2)
+    if plot:
+        import matplotlib
+        matplotlib.use('Agg' if save else 'TKAgg')
+        import matplotlib.pyplot as plt
+        fig = plot_delays(picnums, delays, title=f"{index_2['streamName']} vs {index_1['streamName']}")
+        if save:
+            for path in save:
+                fig.savefig(path)
+                print(f"Plots stored inside '{path}'")
+        else:
+            plt.show()
 
-    
+if __name__ == "__main__":
+    main()
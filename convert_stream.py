@@ -0,0 +1,60 @@
+
+# convert a stream between the two storage formats: directory of .jpg
+# (one file per frame) <=> container (single data file plus index)
+
+# rely on functions defined by analize_stream
+from analize_stream import *
+from stream_storage import StreamContainerWriter, read_frame_bytes, is_container
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("streamdir", help="Directory containing the stream to be converted")
+parser.add_argument("outputdir", help="Directory to put converted stream in, must NOT exist")
+parser.add_argument("-v", "--verbose", dest="verbose", default=False, action=argparse.BooleanOptionalAction, help="Output vebose")
+
+def parse():
+    args = parser.parse_args()
+    if not os.path.exists(args.streamdir):
+        print_err(f"ERROR: missing directory '{args.streamdir}'")
+    if os.path.exists(args.outputdir):
+        print_err(f"ERROR: path '{args.outputdir}' already exists!")
+    return args.streamdir, args.outputdir, args.verbose
+
+# store all the frames of the stream inside a new container
+def directory_to_container(metadata: dict, outputdir, verbose=False):
+    os.mkdir(outputdir)
+    container = StreamContainerWriter(outputdir, metadata["streamName"])
+    for img in metadata["imgdata"]:
+        if verbose:
+            print(f"Appending '{img['basename']}'")
+        container.append(int(img["picNum"]), img["picTime"], read_frame_bytes(img))
+    container.close()
+
+# store all the frames of the stream as .jpg files
+def container_to_directory(metadata: dict, outputdir, verbose=False):
+    os.mkdir(outputdir)
+    for img in metadata["imgdata"]:
+        outpath = os.path.join(outputdir, img["basename"])
+        if verbose:
+            print(f"Writing '{outpath}'")
+        with open(outpath, 'wb') as f:
+            f.write(read_frame_bytes(img))
+    # Hadoop inspired termination
+    with open(os.path.join(outputdir, '_SUCCESS'), 'w'):
+        pass
+
+def main():
+    streamdir, outputdir, verbose = parse()
+    print(f"Examining folder '{streamdir}' ... ", end='')
+    metadata = get_stream_metadata(streamdir)
+    print("DONE!", f"Found {metadata['imageCount']} images")
+    if is_container(streamdir):
+        print(f"Converting container into directory '{outputdir}' ... ", end='')
+        container_to_directory(metadata, outputdir, verbose)
+    else:
+        print(f"Converting directory into container '{outputdir}' ... ", end='')
+        directory_to_container(metadata, outputdir, verbose)
+    print("DONE!")
+
+if __name__ == "__main__":
+    main()
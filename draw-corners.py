@@ -3,6 +3,9 @@ import cv2 as cv
 import glob
 import sys
 import os
+import argparse
+from image_loader import ImageLoader
+from chessboard import CORNERS_CACHE_FILE, CornersCache, detect_chessboards, detection_summary, calibrate_from_detections
 
 # Tutorial:
 #   https://docs.opencv.org/4.x/dc/dbb/tutorial_py_calibration.html
@@ -11,55 +14,58 @@ import os
 ROWS = 6
 COLS = 9
 
-search_dir = sys.argv[1]
+parser = argparse.ArgumentParser()
+parser.add_argument("search_dir", help="Directory containing the chessboard pictures")
+parser.add_argument("workers", nargs='?', default=None, type=int, help="(Optional) Size of the pool used to detect the chessboards")
+parser.add_argument("-l", "--pyramid-levels", dest="pyramid_levels", default=0, type=int, help="Search the chessboard on pictures downscaled N times before refining it")
+parser.add_argument("--fast-check", dest="fast_check", default=False, action=argparse.BooleanOptionalAction, help="Quickly reject pictures without a chessboard")
+args = parser.parse_args()
 
-# termination criteria
-criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-
-# prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
-objp = np.zeros((ROWS*COLS,3), np.float32)
-objp[:,:2] = np.mgrid[0:COLS,0:ROWS].T.reshape(-1,2)
-
-# Arrays to store object points and image points from all the images.
-objpoints = [] # 3d point in real world space
-imgpoints = [] # 2d points in image plane.
+search_dir = args.search_dir
 
+# optional size of the pool used to detect the chessboards
+workers = args.workers
 
 path_to_search = os.path.join(search_dir, '*.jpg')
 
 images = glob.glob(path_to_search)
+images.sort()
 
-for fname in images:
-    print(f"Processing image '{fname}'")
+# detections of previous runs are reused
+cache = CornersCache(os.path.join(search_dir, CORNERS_CACHE_FILE))
 
-    img = cv.imread(fname)
-    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+# Find the chess board corners in all the images (in parallel)
+results = detect_chessboards(images, ROWS, COLS, workers=workers, cache=cache, pyramid_levels=args.pyramid_levels, fast_check=args.fast_check)
 
-    # Find the chess board corners
-    ret, corners = cv.findChessboardCorners(gray, (COLS,ROWS), None)
-
-    print("Found corners:", ret)
+# pictures with a chessboard are decoded in advance while the previous
+# one is shown
+found = ImageLoader([r["path"] for r in results if r["found"]], read_behind=0)
+found_idx = 0
+for r in results:
+    fname = r["path"]
+    print(f"Processing image '{fname}'")
+    print("Found corners:", r["found"], f"({r['time']:.3f}s)")
 
-    # If found, add object points, image points (after refining them)
-    if ret == True:
-        objpoints.append(objp)
-        corners2 = cv.cornerSubPix(gray,corners, (11,11), (-1,-1), criteria)
-        imgpoints.append(corners2)
-        # Draw and display the corners
-        cv.drawChessboardCorners(img, (COLS,ROWS), corners2, ret)
+    # If found, draw and display the (refined) corners
+    if r["found"]:
+        img = found.get(found_idx)
+        found_idx += 1
+        cv.drawChessboardCorners(img, (COLS,ROWS), r["corners"], r["found"])
         cv.imshow('img', img)
         cv.waitKey(5000)
     print("DONE!\n")
 
 cv.destroyAllWindows()
+found.close()
 
 print()
+detection_summary(results)
 print("Calculate correction parameters:")
-ret, mtx, dist, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
+ret, mtx, dist, rvecs, tvecs = calibrate_from_detections(results, ROWS, COLS)
 
-for fname in images:
+loader = ImageLoader(images, read_behind=0)
+for fname, img in zip(images, loader):
     print(f"Undistorting {fname}")
-    img = cv.imread(fname)
     
     h, w = img.shape[:2]
     newcameramtx, roi = cv.getOptimalNewCameraMatrix(mtx, dist, (w,h), 1, (w,h))
@@ -77,5 +83,6 @@ for fname in images:
     cv.imshow('Undistorted img', comparison)
     cv.waitKey(5000)
     #cv.imwrite('calibresult.png', dst)
+loader.close()
 
 
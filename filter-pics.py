@@ -5,11 +5,12 @@ import os
 import datetime
 import sys
 import argparse
-import re
+from image_loader import ImageLoader, REDUCTIONS, reduced_flags
 
 parser = argparse.ArgumentParser()
 parser.add_argument("indir", help="Path to directory containing pics to be filtered")
 parser.add_argument("outdir", help="Path to directory to store chosen pics inside, must NOT exist")
+parser.add_argument("-r", "--reduce", dest="reduce", default=1, type=int, choices=REDUCTIONS, help="Show previews downscaled N times (faster decoding), chosen pics are stored unchanged")
 
 
 def main():
@@ -24,11 +25,10 @@ def main():
         print(f"ERROR: path '{outdir}' already exists!", file=sys.stderr)
         exit(1)
 
-    names = os.listdir(indir)
-    jpg_names = filter(lambda path: re.match(pattern='.*(\.jpg)|(\.jpeg)^', string=path) is not None, names)
-    jpg_paths = map(lambda jpg: os.path.join(indir, jpg), jpg_names)
-    jpg_paths = list(jpg_paths)
-    jpg_paths.sort()
+    # pictures (or frames of a stream container) are memory mapped and
+    # decoded in advance while the user chooses
+    images = ImageLoader(indir, flags=reduced_flags(args.reduce))
+    jpg_paths = list(map(lambda idx: os.path.join(indir, images.name(idx)), range(len(images))))
 
     img_cnt = len(jpg_paths)
     if img_cnt == 0:
@@ -48,8 +48,11 @@ def main():
     img_idx = 0
     for p in jpg_paths:
         img_idx += 1
-        img = cv2.imread(p)
+        img = images.get(img_idx-1)
         img_name = os.path.basename(p)
+        if img is None:
+            print(f"[{img_idx}/{img_cnt}]\t'{img_name}'\tcannot be decoded, skipped")
+            continue
         store = False
         winname = f"[{img_idx}/{img_cnt}] {img_name}"
         cv2.imshow(winname, img)
@@ -60,7 +63,9 @@ def main():
                 store = True
                 print('y', end='')
                 outpath = os.path.join(outdir, img_name)
-                cv2.imwrite(outpath, img)
+                # store the original picture, with no re-encoding
+                with open(outpath, 'wb') as f:
+                    f.write(images.frame_bytes(img_idx-1))
                 print('\tDONE!', end='')
                 break
             if key == ord('n'):
@@ -70,6 +75,8 @@ def main():
         print()
         cv2.destroyWindow(winname)
 
+    images.close()
+
     # Hadoop inspired termination
     with open(os.path.join(outdir, '_SUCCESS'), 'w'):
         pass
@@ -0,0 +1,142 @@
+
+# prefetching loader of the pictures of a folder (or of the frames of a
+# stream container / virtual stream, see stream_storage.StreamReader, or
+# of a list of image files): while the caller works on a picture, the
+# next ones (in the direction the caller is moving) are read and decoded
+# by a pool of threads, the previous ones are kept to go back without
+# decoding them again. The number of decoded pictures kept is bounded by
+# read-ahead + read-behind and by a memory budget.
+
+import os
+import threading
+import concurrent.futures
+import cv2
+from stream_storage import StreamReader, decode_frame
+
+# pictures decoded in advance
+READ_AHEAD = 8
+# pictures kept after the caller moved past them
+READ_BEHIND = 4
+# decoding threads (cv2.imdecode releases the GIL)
+LOADER_THREADS = min(4, os.cpu_count() or 1)
+# memory budget of the decoded pictures kept
+MAX_CACHED_BYTES = 512 * 1024 * 1024
+
+# decoding flags of previews downscaled N times (decoding is faster too)
+REDUCED_COLOR = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+REDUCED_GRAYSCALE = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+REDUCTIONS = tuple(REDUCED_COLOR)
+
+def reduced_flags(reduction: int = 1, grayscale: bool = False) -> int:
+    flags = REDUCED_GRAYSCALE if grayscale else REDUCED_COLOR
+    if reduction not in flags:
+        raise ValueError(f"Unsupported reduction {reduction} (supported: {REDUCTIONS})")
+    return flags[reduction]
+
+# source is a directory (anything StreamReader can read) or a list of
+# image paths. get(idx) returns the decoded picture (None if it cannot be
+# decoded, as cv2.imread), with wrap=True indexes wrap around the ends
+class ImageLoader:
+    def __init__(self, source, read_ahead=READ_AHEAD, read_behind=READ_BEHIND, threads=LOADER_THREADS, max_bytes=MAX_CACHED_BYTES, flags=cv2.IMREAD_COLOR, wrap=False) -> None:
+        if isinstance(source, (str, os.PathLike)):
+            self.reader = StreamReader(source)
+            self.paths = None
+        else:
+            self.reader = None
+            self.paths = list(source)
+        self.read_ahead = read_ahead
+        self.read_behind = read_behind
+        self.max_bytes = max_bytes
+        self.flags = flags
+        self.wrap = wrap
+        # StreamReader is not thread safe
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="image-loader")
+        # index => future of the decoded picture
+        self.cache = {}
+        # size of a decoded picture (known after the first one)
+        self.frame_nbytes = None
+        self.last = None
+        self.direction = 1
+    def __len__(self) -> int:
+        return len(self.reader) if self.reader is not None else len(self.paths)
+    def name(self, idx: int) -> str:
+        if self.reader is not None:
+            return self.reader.name(idx)
+        return os.path.basename(self.paths[idx])
+    def path(self, idx: int) -> str:
+        if self.reader is not None:
+            return os.path.join(self.reader.path, self.reader.name(idx))
+        return self.paths[idx]
+    # compressed bytes of the picture (as stored)
+    def frame_bytes(self, idx: int) -> bytes:
+        if self.reader is not None:
+            with self.lock:
+                return bytes(self.reader.frame_bytes(idx))
+        with open(self.paths[idx], 'rb') as f:
+            return f.read()
+    # executed by the loader threads
+    def decode(self, idx: int):
+        if self.reader is not None:
+            with self.lock:
+                buf = self.reader.frame_bytes(idx)
+            return decode_frame(buf, self.flags)
+        return cv2.imread(self.paths[idx], self.flags)
+    def submit(self, idx: int) -> concurrent.futures.Future:
+        future = self.cache.get(idx)
+        if future is None:
+            future = self.executor.submit(self.decode, idx)
+            self.cache[idx] = future
+        return future
+    # indexes at distance 1..count from idx in the given direction
+    def neighbours(self, idx: int, direction: int, count: int) -> list[int]:
+        n = len(self)
+        indexes = [idx + direction * d for d in range(1, count + 1)]
+        if self.wrap:
+            return list(dict.fromkeys(i % n for i in indexes if i % n != idx))
+        return [i for i in indexes if 0 <= i < n]
+    # read-ahead and read-behind, reduced to fit the memory budget
+    def window(self) -> tuple[int, int]:
+        if not self.frame_nbytes:
+            return self.read_ahead, self.read_behind
+        capacity = max(1, self.max_bytes // self.frame_nbytes) - 1
+        ahead = min(self.read_ahead, capacity)
+        return ahead, min(self.read_behind, capacity - ahead)
+    # schedule the pictures around idx, forget the other ones
+    def prefetch(self, idx: int):
+        ahead, behind = self.window()
+        wanted = [idx] + self.neighbours(idx, self.direction, ahead) + self.neighbours(idx, -self.direction, behind)
+        for i in list(self.cache):
+            if i not in wanted:
+                self.cache.pop(i).cancel()
+        # nearest pictures in the moving direction first
+        for i in wanted:
+            self.submit(i)
+    def get(self, idx: int):
+        n = len(self)
+        if self.wrap:
+            idx %= n
+        elif not 0 <= idx < n:
+            raise IndexError(f"Picture {idx} out of range (0-{n-1})")
+        if self.last is not None and idx != self.last:
+            step = (idx - self.last) % n if self.wrap else idx - self.last
+            self.direction = -1 if (step < 0 or (self.wrap and step > n // 2)) else 1
+        self.last = idx
+        self.prefetch(idx)
+        img = self.cache[idx].result()
+        if img is not None and self.frame_nbytes is None:
+            self.frame_nbytes = img.nbytes
+        return img
+    # sequential reading (batch processing)
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.get(idx)
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.cache.clear()
+        if self.reader is not None:
+            self.reader.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
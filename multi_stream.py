@@ -0,0 +1,187 @@
+
+# capture synchronized streams from many cameras (USB and RTSP) at once
+
+import cv2
+import time
+import timeit
+import os
+import datetime
+import sys
+import argparse
+import re
+import numpy as np
+from capture import TriggerClock, SkewRecorder, SyncCamera, FrameWriter, QUEUE_SIZE, WRITERS, WRITER_POLICIES, BLOCK, JPEG_QUALITY
+from usb_stream import get_camera_id, camera_proprerties, print_err
+
+basedir = os.path.dirname(__file__)
+
+# default trigger frequency
+FPS = 30.0
+# seconds between two consecutive statistics
+STATS_PERIOD = 5.0
+# name of the file reporting the skew between cameras
+SKEW_FILE = "skew.csv"
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cameras", nargs='+', help="Cameras to capture: USB devices (e.g. /dev/video0) or RTSP URLs, optionally as ID=CAMERA (e.g. 3=rtsp://host/stream1 => CAM3)")
+    parser.add_argument("-r", "--resolution", dest="resolution", default=None, help="Resolution 'WIDTH,HEIGHT' of USB cameras")
+    parser.add_argument("-p", "--picdir", dest="picdir", default=None, help="Directory in which streams will be put")
+    parser.add_argument("-f", "--fps", dest="fps", default=FPS, type=float, help="Frequency of synchronized captures")
+    parser.add_argument("-d", "--duration", dest="duration", default=None, type=float, help="(Optional) Stop after this many seconds")
+    parser.add_argument("-w", "--writers", dest="writers", default=WRITERS, type=int, help="Number of threads encoding and storing frames (per camera)")
+    parser.add_argument("-q", "--queue-size", dest="queue_size", default=QUEUE_SIZE, type=int, help="Number of frames waiting to be stored (per camera)")
+    parser.add_argument("--policy", dest="policy", default=BLOCK, choices=WRITER_POLICIES, help="What to do when the writers cannot keep up (default: %(default)s, dropping frames leaves the stream incomplete)")
+    parser.add_argument("--quality", dest="quality", default=JPEG_QUALITY, type=int, help="JPEG quality (0-100) of stored frames")
+    parser.add_argument("--display", dest="display", default=True, action=argparse.BooleanOptionalAction, help="Show the cameras while recording")
+    return parser
+
+# camera argument as (camera ID, camera): "ID=CAMERA" sets the ID
+# explicitly, otherwise it is derived from the camera (see
+# usb_stream.get_camera_id), e.g. different RTSP URLs ending with the
+# same character need an explicit ID
+def parse_camera(arg: str):
+    match = re.fullmatch(r"(?:CAM)?([A-Za-z0-9]+)=(.+)", arg)
+    if match is not None:
+        return f"CAM{match.group(1)}", match.group(2)
+    return get_camera_id(arg), arg
+
+# parse arguments
+def parse():
+    args = get_parser().parse_args()
+    if args.resolution and len(args.resolution) > 0:
+        args.resolution = tuple(map(int, args.resolution.split(',')))
+        if len(args.resolution) != 2:
+            print_err("Invalid parameter resolution:", args.resolution)
+    if args.fps <= 0:
+        print_err("Invalid parameter fps:", args.fps)
+    if not args.display and args.duration is None:
+        print_err("A duration (-d/--duration) is required without display")
+    camIds, cameras = zip(*map(parse_camera, args.cameras))
+    if len(set(camIds)) != len(camIds):
+        print_err("Cameras must have different IDs (use ID=CAMERA):", camIds)
+    picdirname = f"pics-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S.%f')}"
+    if args.picdir:
+        picdirname = os.path.join(args.picdir, picdirname)
+    picdirname = os.path.join(basedir, picdirname)
+    if os.path.exists(picdirname):
+        print_err(f"Invalid path '{picdirname}'")
+    writer_options = {"workers": args.writers, "queue_size": args.queue_size, "policy": args.policy, "quality": args.quality}
+    return list(cameras), list(camIds), args.resolution, picdirname, args.fps, args.duration, writer_options, args.display
+
+# open a camera with the backend suited to it
+def open_camera(cameraId, resolution=None):
+    if cameraId.startswith("rtsp://"):
+        vcap = cv2.VideoCapture(cameraId, cv2.CAP_FFMPEG)
+        camera_proprerties(vcap)
+    else:
+        vcap = cv2.VideoCapture(cameraId, cv2.CAP_ANY)
+        camera_proprerties(vcap, new_resolution=resolution)
+    return vcap
+
+# return the function storing the frames of a stream with the usual
+# naming scheme, the tick is used as picture number so that pictures
+# captured together by different cameras have the same number
+def stream_sink(writer, stream_dir, stream_name):
+    def sink(tick, now, frame):
+        frame_name = f"{stream_name}-pic-N{tick:06d}-{now.strftime('%Y-%m-%d_%H-%M-%S.%f')}.jpg"
+        writer.submit(os.path.join(stream_dir, frame_name), frame)
+    return sink
+
+# calculate and display stats
+def statistics(cameras, camIds, writers, skew, fps):
+    _, skews = skew.skews(last=int(STATS_PERIOD * fps))
+    print(f"Synchronized frames: {len(skews)}")
+    if len(skews):
+        print("\t", "avg skew (ms):", np.mean(skews) * 1000)
+        print("\t", "max skew (ms):", np.max(skews) * 1000)
+    for cam, camId, writer in zip(cameras, camIds, writers):
+        print("\t", f"{camId}:", f"frames {cam.frames}, missed ticks {cam.missed}, writer queue {writer.queue_depth()}, dropped {writer.dropped}")
+    print()
+
+# store the grab instant of every camera (relative to the first one) for
+# each synchronized frame
+def store_skew(picdirname, camIds, skew):
+    ticks, times = skew.common_grabs()
+    path = os.path.join(picdirname, SKEW_FILE)
+    with open(path, 'w') as f:
+        f.write(",".join(["tick", "skew_ms"] + [f"{camId}_ms" for camId in camIds]) + "\n")
+        for tick, t in zip(ticks, times):
+            offsets = (t - t.min()) * 1000
+            f.write(",".join([str(tick), f"{offsets.max():.3f}"] + [f"{o:.3f}" for o in offsets]) + "\n")
+    print(f"Skew between cameras stored inside '{path}'")
+
+def main():
+    cameraIds, camIds, resolution, picdirname, fps, duration, writer_options, display = parse()
+    print(f"cameras: {cameraIds}")
+    print(f"Streams will be saved inside: '{picdirname}'")
+    print()
+
+    vcaps = [open_camera(cameraId, resolution) for cameraId in cameraIds]
+
+    os.mkdir(picdirname)
+    print(f"Created directory '{picdirname}'")
+    now = datetime.datetime.now()
+    stream_dirs = []
+    writers = []
+    sinks = []
+    for camId in camIds:
+        stream_name = f"stream-{camId}-{now.strftime('%Y-%m-%d_%H-%M-%S.%f')}"
+        stream_dir = os.path.join(picdirname, stream_name)
+        os.mkdir(stream_dir)
+        writer = FrameWriter(**writer_options)
+        stream_dirs.append(stream_dir)
+        writers.append(writer)
+        sinks.append(stream_sink(writer, stream_dir, stream_name))
+
+    # every camera has its own thread and writers, so a slow one does
+    # not slow down the others
+    skew = SkewRecorder(len(vcaps))
+    clock = TriggerClock(fps)
+    cameras = [SyncCamera(idx, vcap, clock, skew, sink) for idx, (vcap, sink) in enumerate(zip(vcaps, sinks))]
+
+    print("Commands:")
+    print('\t', "q", "=>", "Quit")
+    print()
+
+    start = timeit.default_timer()
+    last_stats = start
+    while True:
+        if display:
+            for cam, camId in zip(cameras, camIds):
+                frame = cam.latest
+                if frame is not None:
+                    cv2.imshow(f"Camera {camId}", frame)
+            key = cv2.waitKey(10)
+            if key == ord('q'):
+                break
+        else:
+            time.sleep(0.1)
+        now = timeit.default_timer()
+        if duration is not None and now - start >= duration:
+            break
+        if any(map(lambda c: c.failed, cameras)):
+            print("Failed to read camera!", file=sys.stderr)
+            break
+        if now - last_stats >= STATS_PERIOD:
+            statistics(cameras, camIds, writers, skew, fps)
+            last_stats = now
+
+    clock.stop()
+    for cam in cameras:
+        cam.join()
+    statistics(cameras, camIds, writers, skew, fps)
+    # wait for queued frames to be on disk
+    for writer, stream_dir in zip(writers, stream_dirs):
+        if not writer.flush_and_mark(stream_dir):
+            print(f"WARNING: stream '{stream_dir}' is incomplete ({writer.dropped} frames dropped, {writer.errors} not written), not marked with _SUCCESS", file=sys.stderr)
+        writer.stop()
+        if writer.dropped:
+            print(f"Dropped frames of '{stream_dir}': {writer.dropped}")
+    store_skew(picdirname, camIds, skew)
+    if display:
+        cv2.destroyAllWindows()
+    print(f"Streams are available inside directory: '{picdirname}'")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+
+# replay a stored stream in real time: frames are emitted when their
+# (optionally delayed) capture time comes, measured from the start of the
+# replay with a monotonic clock. Frames are served as MJPEG over HTTP on
+# localhost, so that the replay can stand in for a camera (e.g. it can
+# be read with cv2.VideoCapture or capture.LatestFrameReader), or
+# consumed in-process through replay_frames / StreamReplay.frames.
+
+import asyncio
+import time
+import os
+import sys
+import argparse
+import numpy as np
+from stream_index import load_stream_index
+from stream_storage import StreamReader
+
+# default HTTP endpoint
+HOST = "127.0.0.1"
+PORT = 8080
+# multipart boundary of the MJPEG stream
+BOUNDARY = "replayframe"
+
+def print_err(*args, **kwarks):
+    print(*args, **kwarks, file=sys.stderr)
+    exit(1)
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("streamdir", help="Directory containing the stream to replay")
+    parser.add_argument("--host", dest="host", default=HOST, help="Address the HTTP server listens on")
+    parser.add_argument("-p", "--port", dest="port", default=PORT, type=int, help="Port the HTTP server listens on")
+    parser.add_argument("--speed", dest="speed", default=1.0, type=float, help="Replay speed (2 => twice as fast)")
+    parser.add_argument("--loop", dest="loop", default=False, action=argparse.BooleanOptionalAction, help="Start again when the stream ends (with -d/--delay, new delays are drawn for every pass)")
+    parser.add_argument("-d", "--delay", dest="delay", default=None, help="Delay distribution applied to the frames, as in add_latency_to_stream.py")
+    parser.add_argument("-s", "--seed", dest="seed", default=None, type=int, help="Seed of the random delays")
+    return parser
+
+def parse():
+    args = get_parser().parse_args()
+    if not os.path.exists(args.streamdir):
+        print_err(f"ERROR: missing directory '{args.streamdir}'")
+    if args.speed <= 0:
+        print_err("Invalid parameter speed:", args.speed)
+    return args.streamdir, args.host, args.port, args.speed, args.loop, args.delay, args.seed
+
+# frames of the stream in delivery order, as (positions inside the
+# StreamReader, offsets in seconds from the first frame). When a delay
+# generator (see add_latency_to_stream) is given, its delays are added
+# (new delays at every call)
+def replay_schedule(streamdir, delay_generator=None, index=None):
+    if index is None:
+        index = load_stream_index(streamdir)
+    if index["imageCount"] == 0:
+        raise ValueError(f"ERROR: no frame to replay inside '{streamdir}'")
+    frames = np.arange(index["imageCount"])
+    times = index["picTime"]
+    if delay_generator is not None:
+        fake_metadata = delay_generator.generate_fake_metadata(index)
+        frames = fake_metadata["originalIndex"]
+        times = fake_metadata["picTime"]
+    order = np.argsort(times, kind="stable")
+    frames, times = frames[order], times[order]
+    offsets = (times - times[0]).astype(np.int64) / 1e6
+    return frames, offsets
+
+# in-process replay: yield (name, JPEG bytes) of each frame when its time
+# comes (time.monotonic based, late frames are yielded immediately)
+def replay_frames(streamdir, speed=1.0, loop=False, delay_generator=None):
+    reader = StreamReader(streamdir)
+    index = load_stream_index(streamdir)
+    frames, offsets = replay_schedule(streamdir, delay_generator, index)
+    try:
+        while True:
+            start = time.monotonic()
+            for idx, offset in zip(frames.tolist(), offsets.tolist()):
+                wait = start + offset / speed - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                yield reader.name(idx), bytes(reader.frame_bytes(idx))
+            if not loop:
+                break
+            if delay_generator is not None:
+                # every pass has its own delays
+                frames, offsets = replay_schedule(streamdir, delay_generator, index)
+    finally:
+        reader.close()
+
+# asyncio replay of a stream: a single task emits the frames on schedule
+# (loop.time() is monotonic), consumers wait for the newest one, slow
+# consumers skip frames instead of delaying the replay
+class StreamReplay:
+    def __init__(self, streamdir, speed=1.0, loop=False, delay_generator=None) -> None:
+        self.streamdir = streamdir
+        self.speed = speed
+        self.loop = loop
+        self.delay_generator = delay_generator
+        self.index = load_stream_index(streamdir)
+        self.schedule, self.offsets = replay_schedule(streamdir, delay_generator, self.index)
+        self.reader = StreamReader(streamdir)
+        self.cond = asyncio.Condition()
+        self.frame = None
+        self.name = None
+        # sequence number of the newest frame
+        self.seq = 0
+        self.late = 0
+        self.finished = False
+    # emit all the frames (task)
+    async def run(self):
+        clock = asyncio.get_running_loop()
+        try:
+            while True:
+                start = clock.time()
+                for idx, offset in zip(self.schedule.tolist(), self.offsets.tolist()):
+                    wait = start + offset / self.speed - clock.time()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    else:
+                        self.late += 1
+                    async with self.cond:
+                        self.frame = bytes(self.reader.frame_bytes(idx))
+                        self.name = self.reader.name(idx)
+                        self.seq += 1
+                        self.cond.notify_all()
+                if not self.loop:
+                    break
+                if self.delay_generator is not None:
+                    # every pass has its own delays
+                    self.schedule, self.offsets = replay_schedule(self.streamdir, self.delay_generator, self.index)
+        finally:
+            async with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+    # wait for a frame newer than seq, return (seq, name, JPEG bytes) or
+    # None once the replay is over
+    async def next_frame(self, seq: int):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.seq > seq or self.finished)
+            if self.seq <= seq:
+                return None
+            return self.seq, self.name, self.frame
+    # async iterator over the frames, as (name, JPEG bytes)
+    async def frames(self):
+        seq = 0
+        while True:
+            item = await self.next_frame(seq)
+            if item is None:
+                return
+            seq, name, frame = item
+            yield name, frame
+    def close(self):
+        self.reader.close()
+
+# minimal HTTP server: "/" (or any path) streams MJPEG, "/snapshot.jpg"
+# returns the newest frame
+async def serve_client(replay: StreamReplay, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await reader.readline()
+        # skip the headers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.decode('latin-1').split()
+        path = parts[1] if len(parts) > 1 else "/"
+        if path.startswith("/snapshot"):
+            item = await replay.next_frame(replay.seq - 1 if replay.seq else 0)
+            if item is None:
+                writer.write(b"HTTP/1.0 404 Not Found\r\n\r\n")
+            else:
+                writer.write(f"HTTP/1.0 200 OK\r\nContent-Type: image/jpeg\r\nContent-Length: {len(item[2])}\r\n\r\n".encode())
+                writer.write(item[2])
+            await writer.drain()
+            return
+        writer.write(f"HTTP/1.0 200 OK\r\nCache-Control: no-cache\r\nContent-Type: multipart/x-mixed-replace; boundary={BOUNDARY}\r\n\r\n".encode())
+        async for name, frame in replay.frames():
+            writer.write(f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame)}\r\nX-Frame-Name: {name}\r\n\r\n".encode())
+            writer.write(frame)
+            writer.write(b"\r\n")
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(replay: StreamReplay, host=HOST, port=PORT):
+    server = await asyncio.start_server(lambda r, w: serve_client(replay, r, w), host, port)
+    print(f"Serving '{replay.streamdir}' on http://{host}:{port}/ (snapshot: /snapshot.jpg)")
+    task = asyncio.create_task(replay.run())
+    async with server:
+        await task
+        print(f"Replay finished, {replay.seq} frames emitted ({replay.late} late)")
+
+def main():
+    streamdir, host, port, speed, loop, delay, seed = parse()
+    delay_generator = None
+    if delay is not None:
+        # rely on the generators of add_latency_to_stream
+        from add_latency_to_stream import parse_delay_distribution
+        delay_generator = parse_delay_distribution(delay, streamdir, seed)
+    try:
+        replay = StreamReplay(streamdir, speed=speed, loop=loop, delay_generator=delay_generator)
+    except ValueError as e:
+        print_err(e)
+    try:
+        asyncio.run(serve(replay, host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        replay.close()
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,33 @@ import timeit
 import os
 import datetime
 import sys
-from creds import CAMERA_URL
+import argparse
+from capture import FrameWriter, LatestFrameReader, WRITERS, QUEUE_SIZE, WRITER_POLICIES, BLOCK, JPEG_QUALITY
+try:
+  from creds import CAMERA_URL
+except ImportError:
+  CAMERA_URL = None
 
 basedir = os.path.dirname(__file__)
 
-if len(sys.argv) > 1:
-  picdirname = f"pics-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}-{sys.argv[1]}"
+parser = argparse.ArgumentParser()
+parser.add_argument("suffix", nargs='?', default=None, help="(Optional) Suffix of the directory pictures are saved inside")
+parser.add_argument("-w", "--writers", dest="writers", default=WRITERS, type=int, help="Number of threads encoding and storing pictures")
+parser.add_argument("-q", "--queue-size", dest="queue_size", default=QUEUE_SIZE, type=int, help="Number of pictures waiting to be stored")
+parser.add_argument("--policy", dest="policy", default=BLOCK, choices=WRITER_POLICIES, help="What to do when the writers cannot keep up (default: %(default)s, dropping frames leaves the stream incomplete)")
+parser.add_argument("--quality", dest="quality", default=JPEG_QUALITY, type=int, help="JPEG quality (0-100) of stored pictures")
+parser.add_argument("-u", "--url", dest="url", default=CAMERA_URL, help="Stream to be read (default: CAMERA_URL from creds.py), a local file works too")
+parser.add_argument("-l", "--latest", dest="latest", default=False, action=argparse.BooleanOptionalAction, help="Always serve the freshest frame (drain the stream in background and reconnect on errors)")
+args = parser.parse_args()
+if args.url is None:
+  print("ERROR: no stream URL (missing creds.py, use -u/--url)", file=sys.stderr)
+  exit(1)
+if not 0 <= args.quality <= 100:
+  print("Invalid parameter quality:", args.quality, file=sys.stderr)
+  exit(1)
+
+if args.suffix:
+  picdirname = f"pics-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}-{args.suffix}"
 else:
   picdirname = f"pics-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
 
@@ -19,7 +40,13 @@ dir_created = False
 print("Pictures will be saved inside:", picdir)
 
 #vcap = cv2.VideoCapture(CAMERA_URL)
-vcap = cv2.VideoCapture(CAMERA_URL, cv2.CAP_FFMPEG)
+if args.latest:
+  vcap = LatestFrameReader(args.url)
+else:
+  vcap = cv2.VideoCapture(args.url, cv2.CAP_FFMPEG)
+
+# pictures are encoded and stored in background
+writer = FrameWriter(workers=args.writers, queue_size=args.queue_size, policy=args.policy, quality=args.quality)
 
 last_stamp = None
 
@@ -34,6 +61,12 @@ while True:
   start = timeit.default_timer()
   ret, frame_raw = vcap.read()
   delta = timeit.default_timer() - start
+  if not ret and args.latest:
+    # the reader reconnects by itself, just keep the window alive
+    print("No new frame available, waiting...", file=sys.stderr)
+    if cv2.waitKey(1) == ord('q'):
+      break
+    continue
   if not ret:
     print("ERRORE!!!", file=sys.stderr)
     break
@@ -50,6 +83,9 @@ while True:
     print(f"\tavg: \t{sum(delays)/len(delays)}")
     print(f"\tsum: \t{sum(delays)}")
     print(f"\tcount: {len(delays)}")
+    if args.latest:
+      for name, value in vcap.statistics().items():
+        print(f"\t{name}: {value}")
     print()
     delays.clear()
 
@@ -76,15 +112,25 @@ while True:
 
     savepath = os.path.join(picdir, filename)
     print(f"Stampa immagine '{filename}' ({savepath})... ", end='')
-    cv2.imwrite(savepath, frame)
-    print("DONE!")
+    if writer.submit(savepath, frame):
+      print("QUEUED!")
+      SAVED_COUNT += 1
+    else:
+      print("DROPPED!")
     print()
 
-    SAVED_COUNT += 1
-
     if last_stamp is not None:
       last_stamp = timeit.default_timer()
 
+vcap.release()
+
+# wait for all the pictures to be on disk
+if dir_created and not writer.flush_and_mark(picdir):
+  print(f"WARNING: '{picdir}' is incomplete ({writer.dropped} pictures dropped, {writer.errors} not written), not marked with _SUCCESS", file=sys.stderr)
+writer.stop()
+if writer.dropped:
+  print(f"Dropped pictures: {writer.dropped}")
+
 if SAVED_COUNT:
   print(f"Caputerd {SAVED_COUNT} images inside '{os.path.relpath(picdir)}'")
 else:
@@ -7,12 +7,14 @@ import os
 import datetime
 import sys
 import argparse
-import glob
 import re
+import numpy as np
+from image_loader import ImageLoader, REDUCTIONS, reduced_flags
 
 def get_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument("indir", help="Path to directory containing pics to be shown")
+    parser.add_argument("indir", help="Path to directory containing pics (or stream container) to be shown")
+    parser.add_argument("-r", "--reduce", dest="reduce", default=1, type=int, choices=REDUCTIONS, help="Show previews downscaled N times (faster decoding)")
     return parser
 
 def parse():
@@ -20,12 +22,13 @@ def parse():
     if not os.path.isdir(args.indir):
         print(f"ERROR: missing directory '{args.indir}'", file=sys.stderr)
         exit(1)
-    return args.indir
+    return args.indir, args.reduce
 
-def get_images(indir):
-    path_to_search = os.path.join(indir, '*.jpg')
-    images = glob.glob(path_to_search)
-    return images
+# shown in place of the pictures which cannot be decoded
+def placeholder(text, width=640, height=480):
+    mat = np.zeros((height, width, 3), np.uint8)
+    cv2.putText(mat, text, (20, height // 2), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+    return mat
 
 # commands available to the user
 def display_commands():
@@ -36,9 +39,11 @@ def display_commands():
     print()
 
 def main():
-    indir = parse()
+    indir, reduce = parse()
     print(f"Examining folder '{indir}'...")
-    images = get_images(indir)
+    # frames are memory mapped and decoded in advance in the browsing
+    # direction, the previous ones are kept to go back
+    images = ImageLoader(indir, flags=reduced_flags(reduce), wrap=True)
     imgcnt = len(images)
     print(f"Found {imgcnt} images")
     if imgcnt == 0:
@@ -52,10 +57,12 @@ def main():
     while True:
         if changed:
             changed = False
-            imfile = images[idx]
-            imname = os.path.dirname(imfile)
+            imname = images.name(idx)
             imtitle = f"[{idx+1}/{imgcnt}] {imname}"
-            mat = cv2.imread(imfile)
+            mat = images.get(idx)
+            if mat is None:
+                print(f"WARNING: '{imname}' cannot be decoded", file=sys.stderr)
+                mat = placeholder("cannot be decoded")
             cv2.imshow(imtitle, mat)
         key = cv2.waitKey(0)
 
@@ -72,6 +79,7 @@ def main():
             cv2.destroyWindow(imtitle)
 
     cv2.destroyAllWindows()
+    images.close()
 
 
 if __name__ == "__main__":
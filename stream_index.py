@@ -0,0 +1,183 @@
+
+# columnar index of the frames of a stream: instead of a dict per frame,
+# picture numbers, capture times and sizes are kept inside NumPy arrays.
+# File names are parsed at fixed offsets, files are stat-ed via
+# os.scandir and the result is persisted in a sidecar file (next to the
+# stream directory) which is rebuilt only when the stream changes.
+#
+# sample pics file name:
+#   "stream-CAM2-2023-05-30_21-34-27.872104-pic-N000005-2023-05-30_21-34-28.035452.jpg"
+
+import os
+import datetime
+import numpy as np
+from stream_storage import is_container, read_container_index, parse_pic_times, CONTAINER_DATA_FILE, CONTAINER_INDEX_FILE
+from stream_storage import is_virtual, read_virtual_index, virtual_source, is_picture_name, VIRTUAL_INDEX_FILE
+
+# "-pic-N" part of the name, followed by the picture number
+PIC_MARKER = "-pic-N"
+# length of the "-YYYY-mm-dd_HH-MM-SS.ffffff.jpg" tail of the names
+PIC_TIME_TAIL = len("-2023-05-30_21-34-28.035452.jpg")
+# bump when the content of the sidecar changes
+INDEX_VERSION = 1
+
+# path of the sidecar file caching the index of a stream. It is put next
+# to the stream directory, so writing it does not change the directory
+def sidecar_path(streamdir) -> str:
+    streamdir = os.path.normpath(streamdir)
+    return os.path.join(os.path.dirname(streamdir), f".{os.path.basename(streamdir)}.index.npz")
+
+# value changing every time frames are added, removed or renamed
+def stream_signature(streamdir) -> np.ndarray:
+    for index_file in [CONTAINER_INDEX_FILE, VIRTUAL_INDEX_FILE]:
+        if os.path.isfile(os.path.join(streamdir, index_file)):
+            st = os.stat(os.path.join(streamdir, index_file))
+            return np.array([INDEX_VERSION, st.st_mtime_ns, st.st_size], dtype=np.int64)
+    return np.array([INDEX_VERSION, os.stat(streamdir).st_mtime_ns, 0], dtype=np.int64)
+
+# camera ID and start time encoded in a stream name
+def parse_stream_name(stream_name: str):
+    camID, streamTimeStr = stream_name[len("stream-"):].split('-', 1)
+    streamtime = datetime.datetime.strptime(streamTimeStr, '%Y-%m-%d_%H-%M-%S.%f')
+    return camID, streamtime
+
+# names of the frames (the ones they have, or would have, as .jpg files)
+def frame_names(stream_name: str, picNum, picTime) -> np.ndarray:
+    stamps = np.datetime_as_string(np.asarray(picTime, dtype="datetime64[us]"), unit='us')
+    return np.array([f"{stream_name}{PIC_MARKER}{n:06d}-{s[:10]}_{s[11:19].replace(':', '-')}{s[19:]}.jpg" for n, s in zip(picNum.tolist(), stamps)], dtype=str)
+
+# scan the stream and build its index:
+#   streamName  =>  name of the stream
+#   names       =>  file names (sorted)
+#   picNum      =>  int64 picture numbers
+#   picTime     =>  datetime64[us] capture times
+#   fileSize    =>  int64 sizes of the pictures
+#   offset      =>  (containers only) int64 offsets of the payloads
+#   sourceIndex =>  (virtual streams only) positions of the frames inside
+#                   the index of the original stream
+#   signature   =>  see stream_signature
+def build_stream_index(streamdir) -> dict:
+    signature = stream_signature(streamdir)
+    if is_virtual(streamdir):
+        stream_name, source, picNum, picTime, sourceIndex = read_virtual_index(streamdir)
+        original = load_stream_index(source)
+        return {
+            "streamName": stream_name,
+            "names": frame_names(stream_name, picNum, picTime),
+            "picNum": picNum,
+            "picTime": picTime,
+            "fileSize": original["fileSize"][sourceIndex],
+            "sourceIndex": sourceIndex,
+            "signature": signature,
+        }
+    if is_container(streamdir):
+        stream_name, records = read_container_index(streamdir)
+        picTime = records["picTime"].astype("datetime64[us]")
+        return {
+            "streamName": stream_name,
+            "names": frame_names(stream_name, records["picNum"], picTime),
+            "picNum": records["picNum"].copy(),
+            "picTime": picTime,
+            "fileSize": records["length"].copy(),
+            "offset": records["offset"].copy(),
+            "signature": signature,
+        }
+    entries = [(e.name, e.stat().st_size) for e in os.scandir(streamdir) if is_picture_name(e.name) and e.is_file()]
+    if len(entries) == 0:
+        raise ValueError(f"ERROR: no .jpg found inside '{streamdir}'")
+    entries.sort()
+    names = [e[0] for e in entries]
+    # first filename took as reference
+    stream_name = names[0][:names[0].find(PIC_MARKER)]
+    prefix = stream_name + PIC_MARKER
+    # ensure all picture are from the same stream
+    if not stream_name.startswith("stream-") or not np.all(np.char.startswith(np.array(names, dtype=str), prefix)):
+        raise ValueError(f"ERROR: pictures of different (or unknown) streams inside '{streamdir}'")
+    picNum = np.array([n[len(prefix):-PIC_TIME_TAIL] for n in names]).astype(np.int64)
+    picTime = parse_pic_times(names)
+    if picTime is None:
+        raise ValueError(f"ERROR: invalid picture times inside '{streamdir}'")
+    return {
+        "streamName": stream_name,
+        "names": np.array(names, dtype=str),
+        "picNum": picNum,
+        "picTime": picTime,
+        "fileSize": np.array([e[1] for e in entries], dtype=np.int64),
+        "signature": signature,
+    }
+
+# load the index of the stream, from its sidecar if still valid
+def load_stream_index(streamdir, use_sidecar=True) -> dict:
+    sidecar = sidecar_path(streamdir)
+    if use_sidecar and os.path.exists(sidecar):
+        try:
+            with np.load(sidecar) as data:
+                index = {k: data[k] for k in data.files}
+            if np.array_equal(index["signature"], stream_signature(streamdir)):
+                index["streamName"] = str(index["streamName"])
+                return complete_index(streamdir, index)
+        except (OSError, ValueError, KeyError):
+            pass
+    index = build_stream_index(streamdir)
+    if use_sidecar:
+        try:
+            tmp = sidecar + ".tmp"
+            with open(tmp, 'wb') as f:
+                np.savez(f, **index)
+            os.replace(tmp, sidecar)
+        except OSError:
+            # read-only location: simply do not cache
+            pass
+    return complete_index(streamdir, index)
+
+# add the fields which are not stored inside the sidecar (for virtual
+# streams "source", the path of the original stream)
+def complete_index(streamdir, index: dict) -> dict:
+    camID, streamtime = parse_stream_name(index["streamName"])
+    if "sourceIndex" in index:
+        # not cached: the path depends on the current directory
+        index["source"] = virtual_source(streamdir)
+    index["camID"] = camID
+    index["streamTime"] = streamtime
+    index["streamDir"] = os.path.join(os.getcwd(), streamdir)
+    index["container"] = os.path.join(streamdir, CONTAINER_DATA_FILE) if "offset" in index else None
+    index["imageCount"] = len(index["names"])
+    return index
+
+# metadata structure returned by analize_stream.get_stream_metadata (a
+# dict per picture) built from the index of the stream
+def index_to_metadata(streamdir, index: dict) -> dict:
+    names = index["names"].tolist()
+    paths = [os.path.join(streamdir, n) for n in names]
+    picTimes = index["picTime"].astype(datetime.datetime).tolist()
+    stamps = [n[-PIC_TIME_TAIL+1:-4] for n in names]
+    picNums = index["picNum"].tolist()
+    fileSizes = index["fileSize"].tolist()
+    imgdata = [{
+            "path": path,
+            "basename": name,
+            "picNum": f"{picNum:06d}",
+            "picTimeStr": stamp,
+            "picTime": picTime,
+            "fileSize": fileSize,
+        } for path, name, picNum, stamp, picTime, fileSize in zip(paths, names, picNums, stamps, picTimes, fileSizes)]
+    if index["container"] is not None:
+        # where the payload of each frame is
+        for img, offset, length in zip(imgdata, index["offset"].tolist(), fileSizes):
+            img.update({"container": index["container"], "offset": offset, "length": length})
+    elif "sourceIndex" in index:
+        # frames of virtual streams are the ones of the original stream
+        original = index_to_metadata(index["source"], load_stream_index(index["source"]))["imgdata"]
+        for img, idx in zip(imgdata, index["sourceIndex"].tolist()):
+            source = original[idx]
+            img.update({k: source[k] for k in ("container", "offset", "length") if k in source})
+            img["source"] = source["path"]
+    return {
+        "camID": index["camID"],
+        "streamDir": index["streamDir"],
+        "streamName": index["streamName"],
+        "streamTime": index["streamTime"],
+        "images": paths,
+        "imageCount": len(paths),
+        "imgdata": imgdata,
+    }
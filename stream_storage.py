@@ -0,0 +1,363 @@
+
+# container format for streams: instead of one .jpg per frame, all the
+# JPEG payloads of a stream are appended to a single data file and a
+# compact binary index keeps, for each frame, its picture number,
+# capture time, offset and length inside the data file.
+#
+# Index file layout:
+#   INDEX_MAGIC | stream name length (<i8) | stream name (utf-8, padded
+#   to 8 bytes) | records (INDEX_DTYPE)...
+
+import os
+import mmap
+import datetime
+import threading
+import shutil
+import collections
+import numpy as np
+import cv2
+
+CONTAINER_DATA_FILE = "frames.bin"
+CONTAINER_INDEX_FILE = "frames.idx"
+INDEX_MAGIC = b"JPGSTRM1"
+# picTime: microseconds since 1970-01-01 (i.e. datetime64[us])
+INDEX_DTYPE = np.dtype([("picNum", "<i8"), ("picTime", "<i8"), ("offset", "<i8"), ("length", "<i8")])
+
+# is the directory a stream stored as container?
+def is_container(streamdir) -> bool:
+    return os.path.isfile(os.path.join(streamdir, CONTAINER_INDEX_FILE))
+
+# append-only writer of a container, frames can be appended by many
+# threads at once (in any order)
+class StreamContainerWriter:
+    def __init__(self, streamdir, stream_name: str) -> None:
+        self.streamdir = streamdir
+        self.stream_name = stream_name
+        self.lock = threading.Lock()
+        self.data = open(os.path.join(streamdir, CONTAINER_DATA_FILE), 'ab')
+        self.index = open(os.path.join(streamdir, CONTAINER_INDEX_FILE), 'ab')
+        if self.index.tell() == 0:
+            self.index.write(index_header(stream_name))
+        self.count = 0
+    # append the JPEG payload (bytes or uint8 array) of a frame
+    def append(self, picNum: int, picTime: datetime.datetime, payload):
+        payload = memoryview(payload).cast('B')
+        record = np.zeros(1, dtype=INDEX_DTYPE)
+        record["picNum"] = picNum
+        record["picTime"] = np.datetime64(picTime, 'us').astype(np.int64)
+        record["length"] = len(payload)
+        with self.lock:
+            record["offset"] = self.data.tell()
+            self.data.write(payload)
+            self.index.write(record.tobytes())
+            self.count += 1
+    # close the files and (unless mark is False) mark the stream as
+    # complete
+    def close(self, mark=True):
+        with self.lock:
+            self.data.close()
+            self.index.close()
+        if mark:
+            # Hadoop inspired termination
+            with open(os.path.join(self.streamdir, '_SUCCESS'), 'w'):
+                pass
+
+def index_header(stream_name: str) -> bytes:
+    name = stream_name.encode('utf-8')
+    padded = name + b'\0' * (-len(name) % 8)
+    return INDEX_MAGIC + np.int64(len(name)).tobytes() + padded
+
+# read the index of a container, return (stream name, records sorted by
+# picNum). A truncated last record (interrupted writer) is ignored.
+def read_container_index(streamdir):
+    with open(os.path.join(streamdir, CONTAINER_INDEX_FILE), 'rb') as f:
+        raw = f.read()
+    if raw[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+        raise ValueError(f"'{streamdir}' does not contain a valid stream index")
+    name_len = int(np.frombuffer(raw, dtype="<i8", count=1, offset=len(INDEX_MAGIC))[0])
+    begin = len(INDEX_MAGIC) + 8
+    stream_name = raw[begin:begin+name_len].decode('utf-8')
+    begin += name_len + (-name_len % 8)
+    count = (len(raw) - begin) // INDEX_DTYPE.itemsize
+    records = np.frombuffer(raw, dtype=INDEX_DTYPE, count=count, offset=begin)
+    records = records[np.argsort(records["picNum"], kind="stable")]
+    return stream_name, records
+
+# read the JPEG payload of a frame stored inside a container
+def read_container_frame(datafile, offset: int, length: int) -> bytes:
+    with open(datafile, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+# JPEG payload of a frame described by an "imgdata" entry of the
+# metadata, whatever the storage format of its stream
+def read_frame_bytes(imgdata: dict) -> bytes:
+    if "container" in imgdata:
+        return read_container_frame(imgdata["container"], imgdata["offset"], imgdata["length"])
+    with open(frame_source(imgdata), 'rb') as f:
+        return f.read()
+
+# file actually storing a frame which is not inside a container (frames
+# of virtual streams are stored by the original stream)
+def frame_source(imgdata: dict):
+    return imgdata.get("source", imgdata["path"])
+
+
+# how frames are materialized when a stream is derived from another one
+LINK_AUTO = "auto"          # the first of hardlink, reflink, copy working
+LINK_HARDLINK = "hardlink"  # new name of the original file
+LINK_REFLINK = "reflink"    # copy-on-write clone (or copy_file_range)
+LINK_COPY = "copy"          # plain copy
+LINK_VIRTUAL = "virtual"    # no frame written, only the index
+LINK_MODES = [LINK_AUTO, LINK_HARDLINK, LINK_REFLINK, LINK_COPY, LINK_VIRTUAL]
+# ioctl cloning a whole file (linux/fs.h)
+FICLONE = 0x40049409
+
+# clone (size bytes from offset of) src into the dst file: FICLONE when
+# the whole file is cloned, otherwise copy_file_range, which lets the
+# filesystem share the blocks (e.g. Btrfs, XFS, NFS)
+def reflink(src, dst, offset: int = 0, size: int | None = None):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if size is None:
+            try:
+                import fcntl
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except (ImportError, OSError):
+                size = os.fstat(fsrc.fileno()).st_size
+        if not hasattr(os, "copy_file_range"):
+            raise OSError(f"Cannot reflink '{src}'")
+        while size > 0:
+            done = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size, offset)
+            if done == 0:
+                raise OSError(f"Unexpected end of '{src}'")
+            offset += done
+            size -= done
+
+# write the frame described by an "imgdata" entry of the metadata to
+# dst using the given mode (see LINK_MODES, but LINK_VIRTUAL), return
+# the mode actually used
+def link_frame(imgdata: dict, dst, mode=LINK_AUTO) -> str:
+    in_container = "container" in imgdata
+    if mode in (LINK_AUTO, LINK_HARDLINK) and not in_container:
+        try:
+            os.link(frame_source(imgdata), dst)
+            return LINK_HARDLINK
+        except OSError:
+            if mode == LINK_HARDLINK:
+                raise
+    if mode in (LINK_AUTO, LINK_REFLINK):
+        try:
+            if in_container:
+                reflink(imgdata["container"], dst, imgdata["offset"], imgdata["length"])
+            else:
+                reflink(frame_source(imgdata), dst)
+            return LINK_REFLINK
+        except OSError:
+            if mode == LINK_REFLINK:
+                raise
+    if in_container:
+        with open(dst, 'wb') as f:
+            f.write(read_frame_bytes(imgdata))
+    else:
+        shutil.copyfile(frame_source(imgdata), dst)
+    return LINK_COPY
+
+# copy a frame described by an "imgdata" entry of the metadata to dst
+def copy_frame(imgdata: dict, dst):
+    link_frame(imgdata, dst, LINK_COPY)
+
+
+# virtual streams: a delayed version of a stream stored only as index,
+# each frame refers to a frame of the original stream (by its position
+# inside the stream index, i.e. the sorted frame names)
+VIRTUAL_INDEX_FILE = "frames.virtual.npz"
+
+def is_virtual(streamdir) -> bool:
+    return os.path.isfile(os.path.join(streamdir, VIRTUAL_INDEX_FILE))
+
+# store the index of a virtual stream, source is the original stream (if
+# virtual itself, frames refer directly to its original stream)
+def write_virtual_stream(streamdir, stream_name: str, source, picNum, picTime, sourceIndex):
+    source = os.path.abspath(source)
+    sourceIndex = np.asarray(sourceIndex, dtype=np.int64)
+    if is_virtual(source):
+        _, source, _, _, original = read_virtual_index(source)
+        sourceIndex = original[sourceIndex]
+    np.savez(os.path.join(streamdir, VIRTUAL_INDEX_FILE),
+        streamName=stream_name,
+        # relative, so that sessions can be moved
+        source=os.path.relpath(source, os.path.abspath(streamdir)),
+        picNum=np.asarray(picNum, dtype=np.int64),
+        picTime=np.asarray(picTime, dtype="datetime64[us]").astype(np.int64),
+        sourceIndex=sourceIndex,
+    )
+    # Hadoop inspired termination
+    with open(os.path.join(streamdir, '_SUCCESS'), 'w'):
+        pass
+
+# original stream of a virtual stream (its path is stored relative to
+# the virtual stream)
+def virtual_source(streamdir, data=None) -> str:
+    if data is None:
+        with np.load(os.path.join(streamdir, VIRTUAL_INDEX_FILE)) as data:
+            return virtual_source(streamdir, data)
+    return os.path.normpath(os.path.join(streamdir, str(data["source"])))
+
+# read the index of a virtual stream, return (stream name, original
+# stream, picNum, picTime (datetime64[us]), sourceIndex) sorted by name
+def read_virtual_index(streamdir):
+    with np.load(os.path.join(streamdir, VIRTUAL_INDEX_FILE)) as data:
+        stream_name = str(data["streamName"])
+        source = virtual_source(streamdir, data)
+        picNum = data["picNum"]
+        picTime = data["picTime"].astype("datetime64[us]")
+        sourceIndex = data["sourceIndex"]
+    order = np.lexsort((picTime, picNum))
+    return stream_name, source, picNum[order], picTime[order], sourceIndex[order]
+
+# impairments (see add_latency_to_stream.Impairments) applied to a
+# generated stream: picture numbers of the lost, reordered and
+# duplicated frames, together with the delays (ms) added to each picture
+# number (delayPicNum, addedDelay), which give the delivery order before
+# the reordering
+IMPAIRMENTS_FILE = "impairments.npz"
+IMPAIRMENT_KINDS = ("lost", "reordered", "duplicated")
+
+def write_impairments(streamdir, impairments: dict):
+    np.savez(os.path.join(streamdir, IMPAIRMENTS_FILE), **impairments)
+
+# impairments applied to the stream, None if it has not been impaired
+def read_impairments(streamdir) -> dict | None:
+    path = os.path.join(streamdir, IMPAIRMENTS_FILE)
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as data:
+        impairments = {k: data[k] for k in data.files}
+    impairments["parameters"] = str(impairments["parameters"])
+    return impairments
+
+# name of a frame (the one it has, or would have, as .jpg file)
+def frame_name(stream_name: str, picNum: int, picTime) -> str:
+    picTime = np.datetime64(picTime, 'us').astype(datetime.datetime)
+    return f"{stream_name}-pic-N{picNum:06d}-{picTime.strftime('%Y-%m-%d_%H-%M-%S.%f')}.jpg"
+
+
+# number of memory mapped .jpg files kept open by StreamReader
+MAPPED_FILES = 64
+# extension of the pictures of a stream directory
+PICTURE_EXTENSION = ".jpg"
+
+# is the file a picture of a stream directory? (one rule for readers and
+# indexes, so that frame positions always match)
+def is_picture_name(name: str) -> bool:
+    return name.endswith(PICTURE_EXTENSION)
+
+# capture times encoded inside stream file names (datetime64[us]), None
+# if names do not follow the stream naming scheme
+#   sample: "stream-CAM2-...-pic-N000005-2023-05-30_21-34-28.035452.jpg"
+def parse_pic_times(names: list[str]):
+    # fixed size date at the end of the name: YYYY-mm-dd_HH-MM-SS.ffffff
+    stamps = [os.path.splitext(n)[0][-26:] for n in names]
+    iso = [s[:10] + "T" + s[11:19].replace('-', ':') + s[19:] for s in stamps]
+    try:
+        return np.array(iso, dtype="datetime64[us]")
+    except ValueError:
+        return None
+
+# decode compressed frame bytes, None (as cv2.imread) if they cannot be
+# decoded or are empty
+def decode_frame(buf, flags=cv2.IMREAD_COLOR):
+    buf = np.frombuffer(buf, dtype=np.uint8)
+    return cv2.imdecode(buf, flags) if len(buf) else None
+
+# random access reader of a stored stream (container, directory of .jpg
+# files or virtual stream): the storage is memory mapped, compressed frames are
+# accessed without copies by index or by capture time and decoded (with
+# cv2.imdecode) only when requested
+class StreamReader:
+    def __init__(self, path) -> None:
+        self.path = path
+        self.container = is_container(path)
+        self.virtual = is_virtual(path)
+        # frame indexes sorted by capture time (computed when needed)
+        self.order = None
+        if self.virtual:
+            # frames are read from the original stream
+            self.stream_name, source, self.picNums, self.times, self.mapping = read_virtual_index(path)
+            self.source = StreamReader(source)
+        elif self.container:
+            self.stream_name, records = read_container_index(path)
+            self.records = records
+            self.names = None
+            self.picNums = records["picNum"]
+            self.times = records["picTime"].astype("datetime64[us]")
+            self.file = open(os.path.join(path, CONTAINER_DATA_FILE), 'rb')
+            size = os.fstat(self.file.fileno()).st_size
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        else:
+            names = [n for n in os.listdir(path) if is_picture_name(n)]
+            names.sort()
+            self.names = names
+            self.times = parse_pic_times(names)
+            # LRU of memory mapped files: name => mmap (evicted maps are
+            # closed once no frame_bytes view references them anymore)
+            self.mapped = collections.OrderedDict()
+    def __len__(self) -> int:
+        return len(self.times) if self.container or self.virtual else len(self.names)
+    # name of the frame (the one it has, or would have, as .jpg file)
+    def name(self, idx: int) -> str:
+        if not (self.container or self.virtual):
+            return self.names[idx]
+        return frame_name(self.stream_name, int(self.picNums[idx]), self.times[idx])
+    # compressed bytes of the frame, as a memoryview on the mapped storage
+    def frame_bytes(self, idx: int) -> memoryview:
+        if self.virtual:
+            return self.source.frame_bytes(int(self.mapping[idx]))
+        if self.container:
+            r = self.records[idx]
+            return memoryview(self.data)[r["offset"]:r["offset"]+r["length"]]
+        name = self.names[idx]
+        mapped = self.mapped.get(name)
+        if mapped is None:
+            with open(os.path.join(self.path, name), 'rb') as f:
+                # empty files (e.g. truncated captures) cannot be mapped,
+                # like cv2.imread they decode to None
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b'')
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped[name] = mapped
+            if len(self.mapped) > MAPPED_FILES:
+                self.mapped.popitem(last=False)
+        else:
+            self.mapped.move_to_end(name)
+        return memoryview(mapped)
+    # decoded frame
+    def read(self, idx: int, flags=cv2.IMREAD_COLOR):
+        return decode_frame(self.frame_bytes(idx), flags)
+    # index of the frame captured closest to t (datetime or datetime64)
+    def index_at(self, t) -> int:
+        if self.times is None:
+            raise ValueError(f"Capture times not available for '{self.path}'")
+        t = np.datetime64(t, 'us')
+        # frames are not necessarily sorted by time (e.g. delayed streams)
+        if self.order is None:
+            self.order = np.argsort(self.times, kind="stable")
+            self.sorted_times = self.times[self.order]
+        times = self.sorted_times
+        pos = int(np.searchsorted(times, t))
+        if pos == len(times) or (pos > 0 and t - times[pos-1] <= times[pos] - t):
+            pos -= 1
+        return int(self.order[max(pos, 0)])
+    def read_at(self, t, flags=cv2.IMREAD_COLOR):
+        return self.read(self.index_at(t), flags)
+    # release the storage, maps still referenced by frame_bytes views are
+    # closed once those views are gone
+    def close(self):
+        if self.virtual:
+            self.source.close()
+        elif self.container:
+            self.data = b''
+            self.file.close()
+        else:
+            self.mapped.clear()
@@ -0,0 +1,212 @@
+
+# generate many delayed versions of a stream at once: a grid of delay
+# distributions, seeds and impairments (JSON, or YAML when PyYAML is
+# available) is expanded into variants, the original stream is indexed
+# only once and the variants are generated by a pool of processes.
+# A manifest describing every variant is written inside the output
+# directory.
+#
+# sample grid:
+#   {
+#       "distributions": ["const,100", "exp,50", "norm,120,20"],
+#       "seeds": [1, 2],
+#       "impairments": [{}, {"loss": 0.01}, {"burst": [0.01, 0.3], "reorder": [0.05, 3], "duplicate": 0.01}]
+#   }
+# every combination of distribution, seed and impairments is a variant,
+# explicit variants can also be listed:
+#   {"variants": [{"distribution": "exp,50", "seed": 3, "impairments": {"loss": 0.1}}]}
+
+# rely on functions defined by add_latency_to_stream
+from add_latency_to_stream import *
+import itertools
+import shutil
+import concurrent.futures
+
+# name of the manifest (inside the output directory)
+MANIFEST_FILE = "manifest.json"
+
+sweep_parser = argparse.ArgumentParser()
+sweep_parser.add_argument("streamdir", help="Directory containing the original stream")
+sweep_parser.add_argument("outputdir", help="Directory to put the generated streams in (created if missing)")
+sweep_parser.add_argument("grid", help="JSON (or YAML) file describing the variants to generate")
+sweep_parser.add_argument("-w", "--workers", dest="workers", default=None, type=int, help="Number of worker processes (default: number of CPUs)")
+sweep_parser.add_argument("-l", "--link", dest="link", default=LINK_AUTO, choices=LINK_MODES, help="How frames are written (see add_latency_to_stream.py)")
+sweep_parser.add_argument("--skip-existing", dest="skip_existing", default=True, action=argparse.BooleanOptionalAction, help="Do not generate again variants already completed")
+
+# read the grid file
+def load_grid(path) -> dict:
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                print_err("ERROR: PyYAML is required to read YAML grids")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+# list of variants described by the grid: (distribution, seed, impairments)
+def expand_grid(grid: dict) -> list[tuple]:
+    variants = []
+    for v in grid.get("variants", []):
+        variants.append((v["distribution"], v.get("seed"), v.get("impairments", {})))
+    distributions = grid.get("distributions", [])
+    seeds = grid.get("seeds", [None])
+    impairments = grid.get("impairments", [{}])
+    variants.extend(itertools.product(distributions, seeds, impairments))
+    return variants
+
+def build_impairments(parameters: dict, seed) -> Impairments:
+    burst = parameters.get("burst")
+    if burst is not None:
+        burst = tuple(map(float, burst))
+        if len(burst) == 2:
+            burst = burst + (0.0,)
+    reorder = parameters.get("reorder")
+    if reorder is not None:
+        reorder = (float(reorder[0]), int(reorder[1]))
+    unknown = set(parameters) - {"loss", "burst", "reorder", "duplicate"}
+    if unknown:
+        raise ValueError(f"Unknown impairments {sorted(unknown)}")
+    return Impairments(loss=float(parameters.get("loss", 0.0)), burst=burst, reorder=reorder, duplicate=float(parameters.get("duplicate", 0.0)), seed=seed)
+
+# folder containing the variants generated with a given seed, variants
+# differing only by seed have the same stream directory name
+def seed_folder(outputdir, seed) -> str:
+    return outputdir if seed is None else os.path.join(outputdir, f"seed-{seed}")
+
+# directory of the variant of the stream named stream_name
+def variant_dir(stream_name, outputdir, distribution, seed, impairment_parameters) -> str:
+    stream_dir = parse_delay_distribution(distribution, seed_folder(outputdir, seed), seed).stream_dir(stream_name)
+    impairments = build_impairments(impairment_parameters, seed)
+    return stream_dir if impairments.is_empty() else impairments.stream_dir(stream_dir)
+
+def parse():
+    args = sweep_parser.parse_args()
+    if not os.path.exists(args.streamdir):
+        print_err(f"ERROR: missing directory '{args.streamdir}'")
+    if not os.path.isfile(args.grid):
+        print_err(f"ERROR: missing grid '{args.grid}'")
+    if args.workers is not None and args.workers < 1:
+        print_err("Invalid parameter workers:", args.workers)
+    variants = expand_grid(load_grid(args.grid))
+    if len(variants) == 0:
+        print_err(f"ERROR: no variant described by '{args.grid}'")
+    # fail now, not inside the workers
+    targets = {}
+    for distribution, seed, impairments in variants:
+        try:
+            target = variant_dir(os.path.basename(os.path.normpath(args.streamdir)), args.outputdir, distribution, seed, impairments)
+        except (ValueError, TypeError, IndexError) as e:
+            print_err(f"Invalid impairments {impairments}: {e}")
+        # different descriptions of the same variant (e.g. 'exp,50' and
+        # 'exp,50.0') would be written in the same directory
+        vid = variant_id(distribution, seed, impairments)
+        if targets.setdefault(target, vid) != vid:
+            print_err(f"ERROR: variants {targets[target]} and {vid} would be stored in the same directory '{target}'")
+    return args.streamdir, args.outputdir, variants, args.workers, args.link, args.skip_existing
+
+# index of the original stream, loaded once per worker process
+worker_index = None
+
+def init_worker(index):
+    global worker_index
+    worker_index = index
+
+# executed inside the worker processes: generate and store a variant,
+# return its summary
+def generate_variant(distribution, seed, impairment_parameters, outputdir, link):
+    folder = seed_folder(outputdir, seed)
+    os.makedirs(folder, exist_ok=True)
+    delay_generator = parse_delay_distribution(distribution, folder, seed)
+    fake_metadata = delay_generator.generate_fake_metadata(worker_index)
+    impairments = build_impairments(impairment_parameters, seed)
+    if not impairments.is_empty():
+        fake_metadata = impairments.apply(fake_metadata)
+    # the name of the variant is deterministic: left by an interrupted run
+    # (no _SUCCESS) or to be generated again (--no-skip-existing, missing
+    # from the manifest), the directory is replaced
+    if os.path.isdir(fake_metadata["streamDir"]):
+        shutil.rmtree(fake_metadata["streamDir"])
+    create_delayed_sequence(fake_metadata, link)
+    summary = {
+        "frames": int(fake_metadata["imageCount"]),
+        "addedDelay": describe_us(fake_metadata["addedDelay"] * 1000),
+        "timing": analyze_timing(fake_metadata["picTime"], fake_metadata["picNum"]),
+    }
+    if "impairments" in fake_metadata:
+        summary["impairments"] = {k: int(len(fake_metadata["impairments"][k])) for k in IMPAIRMENT_KINDS}
+    return fake_metadata["streamDir"], summary
+
+def load_manifest(outputdir) -> dict:
+    try:
+        with open(os.path.join(outputdir, MANIFEST_FILE)) as f:
+            return {v["id"]: v for v in json.load(f)["variants"]}
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def variant_id(distribution, seed, impairments) -> str:
+    return json.dumps([distribution, seed, impairments], sort_keys=True)
+
+def main():
+    streamdir, outputdir, variants, workers, link, skip_existing = parse()
+    os.makedirs(outputdir, exist_ok=True)
+    print(f"Examining folder '{streamdir}' ... ", end='')
+    try:
+        index = load_stream_index(streamdir)
+    except ValueError as e:
+        print_err(e)
+    print("DONE!", f"Found {index['imageCount']} images")
+
+    previous = load_manifest(outputdir)
+    # variants of previous sweeps are kept in the manifest
+    manifest = {vid: v for vid, v in previous.items() if os.path.exists(os.path.join(v["streamDir"], '_SUCCESS'))}
+    if not skip_existing:
+        previous = {}
+    todo = {}
+    for distribution, seed, impairments in variants:
+        vid = variant_id(distribution, seed, impairments)
+        if not (vid in previous and vid in manifest):
+            todo[vid] = (vid, distribution, seed, impairments)
+    todo = list(todo.values())
+    # variants of previous sweeps described differently (e.g. 'exp,50' and
+    # 'exp,50.0') are replaced by the ones generated now
+    targets = {variant_dir(index["streamName"], outputdir, distribution, seed, impairments) for _, distribution, seed, impairments in todo}
+    manifest = {vid: v for vid, v in manifest.items() if v["streamDir"] not in targets}
+    print(f"Variants to generate: {len(todo)} (already generated: {len(variants) - len(todo)})")
+
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(index,)) as pool:
+        futures = {pool.submit(generate_variant, distribution, seed, impairments, outputdir, link): (vid, distribution, seed, impairments) for vid, distribution, seed, impairments in todo}
+        for future in concurrent.futures.as_completed(futures):
+            vid, distribution, seed, impairments = futures[future]
+            try:
+                stream_dir, summary = future.result()
+            except Exception as e:
+                # a failed variant must not stop the others
+                failed += 1
+                print(f"Failed to generate variant {vid}: {e!r}", file=sys.stderr)
+                continue
+            manifest[vid] = {
+                "id": vid,
+                "distribution": distribution,
+                "seed": seed,
+                "impairments": impairments,
+                "streamDir": stream_dir,
+                "summary": summary,
+            }
+
+    path = os.path.join(outputdir, MANIFEST_FILE)
+    with open(path, 'w') as f:
+        json.dump({
+            "source": index["streamDir"],
+            "streamName": index["streamName"],
+            "link": link,
+            "variants": [manifest[k] for k in sorted(manifest)],
+        }, f, indent=2, default=str)
+    print(f"Manifest of {len(manifest)} variants stored inside '{path}'")
+    if failed:
+        print(f"{failed} variants could not be generated", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
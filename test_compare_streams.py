@@ -0,0 +1,69 @@
+
+# clock offset estimation and impairment scoring of compare_streams on
+# delayed versions of a synthetic stream generated by
+# add_latency_to_stream (run with pytest)
+
+import datetime
+import cv2
+import numpy as np
+import pytest
+from add_latency_to_stream import parse_delay_distribution, create_delayed_sequence, Impairments
+from compare_streams import compare_indexes, score_impairments
+from stream_index import load_stream_index
+from stream_storage import LINK_VIRTUAL, read_impairments
+
+STREAM_NAME = "stream-CAM2-2023-05-30_21-34-27.872104"
+FRAMES = 300
+PERIOD_MS = 33
+
+# 10 s stream: 30 fps with a few ms of capture jitter
+@pytest.fixture(scope="module")
+def source(tmp_path_factory):
+    streamdir = tmp_path_factory.mktemp("source") / STREAM_NAME
+    streamdir.mkdir()
+    rng = np.random.default_rng(12345)
+    start = datetime.datetime(2023, 5, 30, 21, 34, 28)
+    for n in range(FRAMES):
+        t = start + datetime.timedelta(milliseconds=PERIOD_MS * n + int(rng.integers(0, 10)))
+        cv2.imwrite(str(streamdir / f"{STREAM_NAME}-pic-N{n:06d}-{t.strftime('%Y-%m-%d_%H-%M-%S.%f')}.jpg"), np.full((8, 8, 3), n % 255, np.uint8))
+    return str(streamdir)
+
+def delayed(source, outputdir, distribution, seed, impairments=None):
+    delay_generator = parse_delay_distribution(distribution, str(outputdir), seed)
+    fake_metadata = delay_generator.generate_fake_metadata(load_stream_index(source))
+    if impairments is not None:
+        fake_metadata = impairments.apply(fake_metadata)
+    create_delayed_sequence(fake_metadata, LINK_VIRTUAL)
+    return fake_metadata["streamDir"], fake_metadata["addedDelay"]
+
+@pytest.mark.parametrize("distribution", ["const,100", "exp,20", "exp,50", "norm,50,5"])
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_clock_offset_of_random_delays(source, tmp_path, distribution, seed):
+    streamdir, added = delayed(source, tmp_path, distribution, seed)
+    index_1, index_2 = load_stream_index(source), load_stream_index(streamdir)
+    report, _, _ = compare_indexes(index_1, index_2)
+    # frames are not lost: the offset is about the median added delay
+    assert abs(report["clockOffsetMs"] - np.median(added)) < PERIOD_MS / 2
+    report, _, delays = compare_indexes(index_1, index_2, align="time")
+    assert report["matched"] >= FRAMES / 2
+    assert abs(np.median(delays) / 1000.0 - np.median(added)) < PERIOD_MS / 2
+
+def test_clock_offset_with_lost_frames(source, tmp_path):
+    streamdir, _ = delayed(source, tmp_path, "const,100", 1)
+    index_1, index_2 = load_stream_index(source), load_stream_index(streamdir)
+    # every third frame lost
+    keep = np.arange(index_2["imageCount"]) % 3 != 0
+    index_2 = dict(index_2, picNum=index_2["picNum"][keep], picTime=index_2["picTime"][keep])
+    report, _, _ = compare_indexes(index_1, index_2, align="time")
+    assert report["clockOffsetMs"] == pytest.approx(100.0)
+    assert report["matched"] == np.count_nonzero(keep)
+
+# frames overtaken because of random delays are not injected reorderings
+@pytest.mark.parametrize("distribution", ["const,100", "exp,20", "exp,50"])
+def test_impairments_of_random_delays(source, tmp_path, distribution):
+    impairments = Impairments(loss=0.05, reorder=(0.05, 3), duplicate=0.02, seed=3)
+    streamdir, _ = delayed(source, tmp_path, distribution, 3, impairments)
+    score = score_impairments(load_stream_index(source), load_stream_index(streamdir), read_impairments(streamdir))
+    for kind in ("lost", "reordered", "duplicated"):
+        assert score[kind]["precision"] == 1.0
+        assert score[kind]["recall"] == 1.0
@@ -7,68 +7,95 @@ import cv2
 import os
 import argparse
 import re
+from image_loader import ImageLoader
+from chessboard import SUBPIX_CRITERIA, CORNERS_CACHE_FILE, CornersCache, detect_chessboards, detection_summary, calibrate_from_detections
 
 # directory containing picture to locate picture to perform undistortion
 chessdir = os.path.join(os.path.dirname(__file__), 'pics-2023-05-29_16-44-19-CALIBBOARD-OK')
 
-def calculate_undistortion_params(chessdir, ROWS = 6, COLS = 9):
-    ## chessboard size
-    #ROWS = 6
-    #COLS = 9
-    # termination criteria
-    criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-    # prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
-    objp = np.zeros((ROWS*COLS,3), np.float32)
-    objp[:,:2] = np.mgrid[0:COLS,0:ROWS].T.reshape(-1,2)
-    # Arrays to store object points and image points from all the images.
-    objpoints = [] # 3d point in real world space
-    imgpoints = [] # 2d points in image plane.
+# workers: size of the pool used for chessboard detection (None: one per
+# CPU, <= 1: serial), use_processes: use processes instead of threads,
+# use_cache: reuse detections stored inside chessdir by previous runs,
+# pyramid_levels/fast_check: coarse-to-fine detection (see chessboard.py)
+def calculate_undistortion_params(chessdir, ROWS = 6, COLS = 9, workers=None, use_processes=False, use_cache=True, pyramid_levels=0, fast_check=False):
     # locate images
     path_to_search = os.path.join(chessdir, '*.jpg')
     images = glob.glob(path_to_search)
-    for fname in images:
-        img = cv.imread(fname)
-        gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-        # Find the chess board corners
-        ret, corners = cv.findChessboardCorners(gray, (COLS,ROWS), None)
-        # If found, add object points, image points (after refining them)
-        if ret == True:
-            objpoints.append(objp)
-            corners2 = cv.cornerSubPix(gray,corners, (11,11), (-1,-1), criteria)
-            imgpoints.append(corners2)
-    # Doc:
-    #  https://docs.opencv.org/4.x/d9/d0c/group__calib3d.html#ga3207604e4b1a1758aa66acb6ed5aa65d
-    ret, mtx, dist, rvecs, tvecs = cv.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
-    return (ret, mtx, dist, rvecs, tvecs)
-
-def store_or_show_undistorted_images(pic_dir, calibration_mtx, calibration_dist, outdir=None, waitKeyTimeout=0, assert_img_width=None, assert_img_height=None):
-    mtx = calibration_mtx
-    dist = calibration_dist
-    path_to_search = os.path.join(pic_dir, "*.jpg")
-    images = glob.glob(path_to_search)
+    images.sort()
+    cache = CornersCache(os.path.join(chessdir, CORNERS_CACHE_FILE)) if use_cache else None
+    # Find the chess board corners (refined) in all the images
+    results = detect_chessboards(images, ROWS, COLS, criteria=SUBPIX_CRITERIA, workers=workers, use_processes=use_processes, cache=cache, pyramid_levels=pyramid_levels, fast_check=fast_check)
+    detection_summary(results)
+    return calibrate_from_detections(results, ROWS, COLS)
+
+# undistortion engine: the remap tables only depend on the calibration
+# parameters and on the image resolution, so they are computed once (per
+# resolution) and then every frame is undistorted with a cheap cv.remap
+class Undistorter:
+    # alpha: free scaling parameter of cv.getOptimalNewCameraMatrix
+    # fixed_point: use compact CV_16SC2 maps (less memory, same speed)
+    def __init__(self, mtx, dist, alpha: float = 1, fixed_point: bool = False) -> None:
+        self.mtx = mtx
+        self.dist = dist
+        self.alpha = alpha
+        self.map_type = cv.CV_16SC2 if fixed_point else cv.CV_32FC1
+        # (width, height) => (map1, map2, roi)
+        self.maps = {}
+    # get (and build if missing) the remap tables for the given resolution
+    def get_maps(self, w: int, h: int):
+        key = (w, h)
+        if key not in self.maps:
+            newcameramtx, roi = cv.getOptimalNewCameraMatrix(self.mtx, self.dist, (w,h), self.alpha, (w,h))
+            # Doc:
+            #  https://docs.opencv.org/4.x/d9/d0c/group__calib3d.html#ga7dfb72c9cf9780a347fbe3d1c47e5d5a
+            map1, map2 = cv.initUndistortRectifyMap(self.mtx, self.dist, None, newcameramtx, (w,h), self.map_type)
+            self.maps[key] = (map1, map2, roi)
+        return self.maps[key]
+    # undistort the whole image, return it with the ROI of valid pixels
+    def undistort(self, img):
+        h, w = img.shape[:2]
+        map1, map2, roi = self.get_maps(w, h)
+        dst = cv.remap(img, map1, map2, cv.INTER_LINEAR)
+        return dst, roi
+    # undistort the image and crop it to the ROI of valid pixels
+    def undistort_and_crop(self, img):
+        dst, roi = self.undistort(img)
+        x, y, w, h = roi
+        return dst[y:y+h, x:x+w], roi
+
+
+# put original and (cropped) undistorted image one above the other
+def compare_undistorted(img, dst, roi):
+    x, y, w, h = roi
+    img_und = np.zeros(img.shape, np.uint8)
+    img_und[y:y+h, x:x+w] = dst
+    comparison = np.concatenate((img, img_und), axis=0)
+    comparison = cv.resize(comparison, tuple(map(lambda n:n//2, comparison.shape[0:2])))
+    return comparison
+
+
+def store_or_show_undistorted_images(pic_dir, calibration_mtx, calibration_dist, outdir=None, waitKeyTimeout=0, assert_img_width=None, assert_img_height=None, undistorter=None, fixed_point=False):
+    # tables are shared by all the images in the folder
+    if undistorter is None:
+        undistorter = Undistorter(calibration_mtx, calibration_dist, fixed_point=fixed_point)
+    # pictures (or frames of a stream container) are memory mapped and
+    # decoded in advance while the previous ones are undistorted
+    images = ImageLoader(pic_dir, read_behind=0)
     img_cnt = len(images)
     img_idx = 0
-    for p in images:
+    for idx, img in enumerate(images):
         img_idx += 1
-        img = cv2.imread(p)
-        img_name = os.path.basename(p)
+        img_name = images.name(idx)
+        if img is None:
+            print(f"Skipping '{img_name}': cannot be decoded")
+            continue
 
-        # load and undistort img
-        h, w = img.shape[:2]
-        newcameramtx, roi = cv.getOptimalNewCameraMatrix(mtx, dist, (w,h), 1, (w,h))
-        # undistort
-        dst = cv.undistort(img, mtx, dist, None, newcameramtx)
-        # crop the image
-        x, y, w, h = roi
-        dst = dst[y:y+h, x:x+w]
-
-        # show old and undistorted image
-        img_und = np.zeros(img.shape, np.uint8)
-        img_und[y:y+h, x:x+w] = dst
-        comparison = np.concatenate((img, img_und), axis=0)
-        comparison = cv.resize(comparison, tuple(map(lambda n:n//2, comparison.shape[0:2])))
+        # undistort and crop the image
+        dst, roi = undistorter.undistort_and_crop(img)
 
         if waitKeyTimeout is not None:
+            # show old and undistorted image
+            comparison = compare_undistorted(img, dst, roi)
             winname = f"[{img_idx}/{img_cnt}] Undistorted {img_name}"
             cv2.imshow(winname, comparison)
             cv.waitKey(waitKeyTimeout)
@@ -80,10 +107,11 @@ def store_or_show_undistorted_images(pic_dir, calibration_mtx, calibration_dist,
             cv2.imwrite(outpath, dst)
             print("Saved", outpath)
             print()
+    images.close()
 
 
-def show_undistorted_images(pic_dir, mtx, dist, waitKeyTimeout=0, assert_img_width=None, assert_img_height=None):
-    store_or_show_undistorted_images(pic_dir, mtx, dist, outdir=None, waitKeyTimeout=waitKeyTimeout, assert_img_width=assert_img_width, assert_img_height=assert_img_height)
+def show_undistorted_images(pic_dir, mtx, dist, waitKeyTimeout=0, assert_img_width=None, assert_img_height=None, fixed_point=False):
+    store_or_show_undistorted_images(pic_dir, mtx, dist, outdir=None, waitKeyTimeout=waitKeyTimeout, assert_img_width=assert_img_width, assert_img_height=assert_img_height, fixed_point=fixed_point)
 
 
 parser = argparse.ArgumentParser()
@@ -127,26 +155,19 @@ def main():
     ret, mtx, dist, rvecs, tvecs = calculate_undistortion_params(chessdir)
 
     # show undistorted images
+    undistorter = Undistorter(mtx, dist)
+    # next pictures are decoded while the user looks at the current one
+    images = ImageLoader(jpg_paths, read_behind=0)
     img_idx = 0
-    for p in jpg_paths:
+    for p, img in zip(jpg_paths, images):
         img_idx += 1
-        img = cv2.imread(p)
         img_name = os.path.basename(p)
 
-        # load and undistort img
-        h, w = img.shape[:2]
-        newcameramtx, roi = cv.getOptimalNewCameraMatrix(mtx, dist, (w,h), 1, (w,h))
-        # undistort
-        dst = cv.undistort(img, mtx, dist, None, newcameramtx)
-        # crop the image
-        x, y, w, h = roi
-        dst = dst[y:y+h, x:x+w]
+        # undistort and crop the image
+        dst, roi = undistorter.undistort_and_crop(img)
 
         # show old and undistorted image
-        img_und = np.zeros(img.shape, np.uint8)
-        img_und[y:y+h, x:x+w] = dst
-        comparison = np.concatenate((img, img_und), axis=0)
-        comparison = cv.resize(comparison, tuple(map(lambda n:n//2, comparison.shape[0:2])))
+        comparison = compare_undistorted(img, dst, roi)
 
         winname = f"[{img_idx}/{img_cnt}] Undistorted {img_name}"
         cv2.imshow(winname, comparison)
@@ -158,6 +179,7 @@ def main():
         cv2.imwrite(outpath, dst)
         print("Saved", outpath)
         print()
+    images.close()
 
     # Hadoop inspired termination
     with open(os.path.join(outdir, '_SUCCESS'), 'w'):
@@ -6,14 +6,17 @@ import sys
 import argparse
 import numpy as np
 import glob
+import multiprocessing
 from calibrate_camera import calibration_img_width_file, calibration_img_height_file, calibration_mtx_file, calibration_dist_file
-from undistort_folder import store_or_show_undistorted_images
+from undistort_folder import store_or_show_undistorted_images, Undistorter
 
 parser = argparse.ArgumentParser()
 parser.add_argument("calibrationdir", help="Directory containing parameters to perform undistortion")
 parser.add_argument("inputdir", help="Directory containing images to be undistorted")
 parser.add_argument("-o", "--outputdir", default=None, dest="outputdir", help="(Optional) Directory to store undistorted images in (if not supplied images are only displayed)")
 parser.add_argument("-t", "--timeout", default=0, type=int, dest="timeout", help="(Optional) Timeout for images to be shown (negative to show nothing)")
+parser.add_argument("-f", "--fixed-point", default=False, dest="fixed_point", action=argparse.BooleanOptionalAction, help="(Optional) Use compact fixed-point (CV_16SC2) undistortion maps")
+parser.add_argument("-w", "--workers", default=0, type=int, dest="workers", help="(Optional) Undistort images using a pool of N processes (requires -o, nothing is shown)")
 
 # read calibrationdir and extract calibration parameter:
 #   calibration_img_width   =>  width of the images
@@ -22,15 +25,15 @@ parser.add_argument("-t", "--timeout", default=0, type=int, dest="timeout", help
 #   calibration_dist        =>  vector of distortion coefficients
 def load_calibration_parameters(calibrationdir):
     # compose path to files
-    calibration_img_width_file = os.path.join(calibrationdir, calibration_img_width_file)
-    calibration_img_height_file = os.path.join(calibrationdir, calibration_img_height_file)
-    calibration_mtx_file = os.path.join(calibrationdir, calibration_mtx_file)
-    calibration_dist_file = os.path.join(calibrationdir, calibration_dist_file)
+    img_width_path = os.path.join(calibrationdir, calibration_img_width_file)
+    img_height_path = os.path.join(calibrationdir, calibration_img_height_file)
+    mtx_path = os.path.join(calibrationdir, calibration_mtx_file)
+    dist_path = os.path.join(calibrationdir, calibration_dist_file)
     # load data
-    calibration_img_width = np.load(calibration_img_width_file)
-    calibration_img_height = np.load(calibration_img_height_file)
-    calibration_mtx = np.load(calibration_mtx_file)
-    calibration_dist = np.load(calibration_dist_file)
+    calibration_img_width = np.load(img_width_path)
+    calibration_img_height = np.load(img_height_path)
+    calibration_mtx = np.load(mtx_path)
+    calibration_dist = np.load(dist_path)
     # return parameters
     return calibration_img_width, calibration_img_height, calibration_mtx, calibration_dist
 
@@ -48,7 +51,13 @@ def parse():
         exit(1)
     if args.timeout < 0:
         args.timeout = None
-    return args.calibrationdir, args.inputdir, args.outputdir, args.timeout
+    if args.workers < 0:
+        print(F"ERROR: invalid number of workers '{args.workers}'", file=sys.stderr)
+        exit(1)
+    if args.workers and not args.outputdir:
+        print(F"ERROR: parallel undistortion (-w/--workers) requires an output directory (-o/--outputdir)", file=sys.stderr)
+        exit(1)
+    return args.calibrationdir, args.inputdir, args.outputdir, args.timeout, args.fixed_point, args.workers
 
 def get_input_image_names(inputdir):
     path_to_search = os.path.join(inputdir, '*.jpg')
@@ -56,8 +65,58 @@ def get_input_image_names(inputdir):
     images.sort()
     return images
 
+# undistortion engine of the current worker process, built only once
+# by init_worker from the calibration parameters
+worker_undistorter = None
+
+def init_worker(calibration_mtx, calibration_dist, fixed_point):
+    global worker_undistorter
+    worker_undistorter = Undistorter(calibration_mtx, calibration_dist, fixed_point=fixed_point)
+
+# executed inside the worker processes: decode, undistort and encode
+# a single image, the encoded .jpg is sent back to be written (None if
+# the image cannot be decoded and is skipped)
+def undistort_file(path):
+    img = cv2.imread(path)
+    if img is None:
+        return os.path.getsize(path), None
+    dst, _ = worker_undistorter.undistort_and_crop(img)
+    ret, buf = cv2.imencode('.jpg', dst)
+    if not ret:
+        raise RuntimeError(f"Cannot encode undistorted image '{path}'")
+    return os.path.getsize(path), buf
+
+# undistort all the images using a pool of processes, output files are
+# written by the caller process in the same order of 'images'
+def parallel_undistort_images(images, outputdir, calibration_mtx, calibration_dist, workers, fixed_point=False):
+    read_bytes = 0
+    written_bytes = 0
+    skipped = []
+    start = timeit.default_timer()
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(calibration_mtx, calibration_dist, fixed_point)) as pool:
+        results = pool.imap(undistort_file, images, chunksize=4)
+        for p, (size, buf) in zip(images, results):
+            read_bytes += size
+            if buf is None:
+                print(f"Skipping '{os.path.basename(p)}': cannot be decoded")
+                skipped.append(p)
+                continue
+            outpath = os.path.join(outputdir, os.path.basename(p))
+            buf.tofile(outpath)
+            written_bytes += buf.nbytes
+    elapsed = timeit.default_timer() - start
+    # throughput summary
+    print(f"Undistorted {len(images) - len(skipped)} images in {elapsed:.3f}s using {workers} workers")
+    if skipped:
+        print("\t", f"skipped (cannot be decoded): {len(skipped)}")
+    if elapsed > 0:
+        print("\t", "frames/s:", len(images)/elapsed)
+        print("\t", "read MB/s:", read_bytes/elapsed/1e6)
+        print("\t", "written MB/s:", written_bytes/elapsed/1e6)
+    print()
+
 def main():
-    calibrationdir, inputdir, outputdir, timeout = parse()
+    calibrationdir, inputdir, outputdir, timeout, fixed_point, workers = parse()
     print(f"Retrieving calibration parameters from '{calibrationdir}' ...", end='')
     calibration_img_width, calibration_img_height, calibration_mtx, calibration_dist = load_calibration_parameters(calibrationdir)
     print("DONE!")
@@ -67,10 +126,24 @@ def main():
     print("DONE!")
     print(f"Found {len(images)} images")
 
-    # if output dir available, store undistorted images inside
-    store_or_show_undistorted_images(pic_dir=inputdir, outdir=outputdir,
-        calibration_mtx=calibration_mtx, calibration_dist=calibration_dist,
-        waitKeyTimeout=timeout)
+    if outputdir:
+        os.mkdir(outputdir)
+        print(f"Directory '{outputdir}' created!")
+
+    if workers:
+        parallel_undistort_images(images, outputdir,
+            calibration_mtx=calibration_mtx, calibration_dist=calibration_dist,
+            workers=workers, fixed_point=fixed_point)
+    else:
+        # if output dir available, store undistorted images inside
+        store_or_show_undistorted_images(pic_dir=inputdir, outdir=outputdir,
+            calibration_mtx=calibration_mtx, calibration_dist=calibration_dist,
+            waitKeyTimeout=timeout, fixed_point=fixed_point)
+
+    if outputdir:
+        # Hadoop inspired termination
+        with open(os.path.join(outputdir, '_SUCCESS'), 'w'):
+            pass
 
 if __name__ == "__main__":
     main()
@@ -6,6 +6,9 @@ import datetime
 import sys
 import argparse
 import numpy as np
+import functools
+from stream_storage import StreamContainerWriter
+from capture import FrameGrabber, FrameWriter, negotiate_mjpeg, enable_raw_mode, decode_frame, QUEUE_SIZE, WRITERS, WRITER_POLICIES, BLOCK, JPEG_QUALITY
 
 basedir = os.path.dirname(__file__)
 
@@ -14,6 +17,13 @@ def get_parser():
     parser.add_argument("cameraId", help="Argument for cv2.VideoCapture(0)")
     parser.add_argument("-r", "--resolution", dest="resolution", default=None, help="Argument for cv2.VideoCapture(0)")
     parser.add_argument("-p", "--picdir", dest="picdir", default=None, help="Directory in which selected frame will be put")
+    parser.add_argument("-q", "--queue-size", dest="queue_size", default=QUEUE_SIZE, type=int, help="Size of the queues between grabber, display and writers")
+    parser.add_argument("-w", "--writers", dest="writers", default=WRITERS, type=int, help="Number of threads encoding and storing frames")
+    parser.add_argument("--policy", dest="policy", default=BLOCK, choices=WRITER_POLICIES, help="What to do when the writers cannot keep up (default: %(default)s, dropping frames leaves the stream incomplete)")
+    parser.add_argument("--quality", dest="quality", default=JPEG_QUALITY, type=int, help="JPEG quality (0-100) of stored frames")
+    parser.add_argument("-m", "--mjpeg", dest="mjpeg", default=False, action=argparse.BooleanOptionalAction, help="Ask the camera for MJPG compressed frames")
+    parser.add_argument("--passthrough", dest="passthrough", default=False, action=argparse.BooleanOptionalAction, help="(With --mjpeg) Store the JPEG sent by the camera as it is, decode only displayed frames")
+    parser.add_argument("-c", "--container", dest="container", default=False, action=argparse.BooleanOptionalAction, help="Store each stream as a single container file (with index) instead of one .jpg per frame")
     return parser
 
 # STATS parameters
@@ -32,6 +42,14 @@ def parse():
         if len(args.resolution) != 2:
             print("Invalid parameter resolution:", args.resolution, file=sys.stderr)
             exit(1)
+    if args.queue_size < 1:
+        print_err("Invalid parameter queue-size:", args.queue_size)
+    if args.writers < 1:
+        print_err("Invalid parameter writers:", args.writers)
+    if not 0 <= args.quality <= 100:
+        print_err("Invalid parameter quality:", args.quality)
+    if args.passthrough and not args.mjpeg:
+        print_err("--passthrough requires --mjpeg")
     if args.picdir:
         dirname = os.path.dirname(args.picdir)
         basename = os.path.basename(args.picdir)
@@ -43,7 +61,8 @@ def parse():
     if os.path.exists(picdirname):
         print_err(f"Invalid path '{picdirname}'")
 
-    return args.cameraId, args.resolution, picdirname
+    writer_options = {"workers": args.writers, "queue_size": args.queue_size, "policy": args.policy, "quality": args.quality}
+    return args.cameraId, args.resolution, picdirname, args.queue_size, writer_options, args.mjpeg, args.passthrough, args.container
 
 # commands available to the user
 def display_commands():
@@ -52,8 +71,8 @@ def display_commands():
     print('\t', "a", "=>", "Start capturing all the frames and storing them inside the given directory")
     print()
 
-# calculate and display stats
-def statistics(measures: list[float]):
+# calculate and display stats, counters are printed as they are
+def statistics(measures: list[float], counters: dict | None = None):
     count = len(measures)
     print(f"Measures: {count}")
     if count:
@@ -65,6 +84,9 @@ def statistics(measures: list[float]):
         print("\t", "max:", np.max(measures))
         print("\t", "Framerate:", count/sum)
         measures.clear()
+    if counters:
+        for name, value in counters.items():
+            print("\t", f"{name}:", value)
     print()
 
 # display capture properties
@@ -93,11 +115,25 @@ def store_img(picdirname, img):
     print()
 
 
+# wait for all the frames of a stream to be on disk, then mark it as
+# complete (closing its container, if any). Streams with frames which
+# were dropped or could not be written are not marked, False is returned
+def terminate_stream(writer, stream_dir, container=None) -> bool:
+    if container is None:
+        complete = writer.flush_and_mark(stream_dir)
+    else:
+        complete = writer.flush() == 0
+        container.close(mark=complete)
+    if not complete:
+        print(f"WARNING: stream '{stream_dir}' is incomplete (frames dropped or not written), not marked with _SUCCESS", file=sys.stderr)
+    return complete
+
+
 def get_camera_id(cameraId):
     return f"CAM{cameraId[-1]}"
 
 def main():
-    cameraId, resolution, picdirname = parse()
+    cameraId, resolution, picdirname, queue_size, writer_options, mjpeg, passthrough, use_container = parse()
     print(f"cameraId: {cameraId}")
     print(f"Images will be saved inside: '{picdirname}'")
     print()
@@ -108,15 +144,28 @@ def main():
     picdir = False
 
     vcap = cv2.VideoCapture(cameraId, cv2.CAP_ANY)
-    # https://stackoverflow.com/questions/54249824/low-fps-by-using-cv2-videocapture
-    # if not vcap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc('m','j','p','g')):
-    #     print_err("BUUUM")
+    if mjpeg:
+        if negotiate_mjpeg(vcap):
+            print("Camera is sending MJPG frames")
+        else:
+            print("Camera does not support MJPG, using its default format", file=sys.stderr)
+            passthrough = False
     camera_proprerties(vcap, new_resolution=resolution)
+    if passthrough:
+        # frames are now JPEG buffers, stored with no decode+encode
+        if enable_raw_mode(vcap):
+            print("Storing camera JPEG frames as they are")
+        else:
+            print("Camera backend cannot return raw JPEG frames, they will be re-encoded", file=sys.stderr)
 
     img_title = f"Camera {cameraId}"
 
     display_commands()
 
+    # capture pipeline: grabber thread => main loop (display) => writers
+    grabber = FrameGrabber(vcap, queue_size=queue_size)
+    writer = FrameWriter(**writer_options)
+
     # flag to exit the loop
     quit = False
     # flag to be used to capture all the frames
@@ -125,20 +174,26 @@ def main():
     capture_all_dir = None
     # stream size
     stream_size = None
+    # writer of the stream container (if frames are not stored as .jpg)
+    container = None
     while True:
-        start = timeit.default_timer()
-        ret, frame = vcap.read()
-        delta = timeit.default_timer() - start
-        # time reference to be used for stream construction
-        now = datetime.datetime.now()
-
-        stats.append(delta)
+        item = grabber.get()
+        key = -1
 
-        if not ret:
+        if item is None:
             print("Failed to read camera!", file=sys.stderr)
             break
         else:
-            cv2.imshow(img_title, frame)
+            # time reference to be used for stream construction is
+            # taken by the grabber right after the capture
+            frame, now, delta = item
+            stats.append(delta)
+
+            # display only the most recent frame: if more frames are
+            # already waiting this one is only stored (not decoded). Keys
+            # are polled anyway, the user is not ignored while catching up
+            if not grabber.has_more():
+                cv2.imshow(img_title, decode_frame(frame))
             key = cv2.waitKey(1)
             if key == ord('q'):
                 quit = True
@@ -153,9 +208,14 @@ def main():
                     stream_name = f"stream-{camId}-{now.strftime('%Y-%m-%d_%H-%M-%S.%f')}"
                     capture_all_dir = os.path.join(picdirname, stream_name)
                     os.mkdir(capture_all_dir)
+                    if use_container:
+                        container = StreamContainerWriter(capture_all_dir, stream_name)
                     stream_size = 0
                 else:
                     capture_all = False
+                    # stream is complete only once all its frames are on disk
+                    terminate_stream(writer, capture_all_dir, container)
+                    container = None
                     print(f"Stream '{stream_name}' terminated => final size: {stream_size}")
 
             if capture_all:
@@ -163,20 +223,40 @@ def main():
                 # randomly print infos about frames in stream
                 if stream_size % 222 == 0:
                     print(f"Stream '{stream_name}': frame count: {stream_size}")
-                # keep a reference to the stream name
-                frame_name = f"{stream_name}-pic-N{stream_size-1:06d}-{now.strftime('%Y-%m-%d_%H-%M-%S.%f')}.jpg"
-                outpath = os.path.join(capture_all_dir, frame_name)
-                cv2.imwrite(outpath, frame)
+                if container is not None:
+                    # frame number and time are kept inside the index
+                    writer.submit(functools.partial(container.append, stream_size-1, now), frame)
+                else:
+                    # keep a reference to the stream name
+                    frame_name = f"{stream_name}-pic-N{stream_size-1:06d}-{now.strftime('%Y-%m-%d_%H-%M-%S.%f')}.jpg"
+                    outpath = os.path.join(capture_all_dir, frame_name)
+                    writer.submit(outpath, frame)
                 pass
 
         if quit or key == ord('i') or len(stats) == MEASURES_PER_STATS:
-            statistics(stats)
+            statistics(stats, {
+                "grabber queue": grabber.queue_depth(),
+                "grabber dropped": grabber.dropped,
+                "writer queue": writer.queue_depth(),
+                "writer dropped": writer.dropped,
+            })
 
         # exit only after last stats have been published 
         if quit:
             print("Quit")
             break
 
+    grabber.stop()
+    # wait for queued frames to be on disk
+    if capture_all:
+        terminate_stream(writer, capture_all_dir, container)
+        print(f"Stream '{stream_name}' terminated => final size: {stream_size}")
+    writer.stop()
+    if writer.dropped or grabber.dropped:
+        print(f"Dropped frames: {grabber.dropped} (grabber), {writer.dropped} (writer)")
+    if writer.errors:
+        print(f"Frames which could not be written: {writer.errors}", file=sys.stderr)
+
     # summary
     if stream_size is not None:
         print(f"Streams are available inside directory: '{picdirname}'")